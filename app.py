@@ -1,36 +1,58 @@
 import os
+import re
+import sys
+import json
 import math
-import pandas as pd
+import time
+import queue
+import hashlib
+import secrets
+import select
+import threading
+import unicodedata
+import subprocess
 from io import BytesIO
-from flask import Flask, render_template, request, redirect, session, url_for, g, send_file, flash, jsonify
-from datetime import datetime, timedelta
+from itertools import chain
+import click
+from flask import Flask, Request, Response, render_template, request, redirect, session, url_for, g, send_file, flash, jsonify, has_request_context
+from datetime import date, datetime, timedelta
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
-from waitress import serve
 from werkzeug.datastructures import MultiDict
 import psycopg2
-from psycopg2.extras import DictCursor
-import boto3 # Biblioteca da AWS
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extras import DictCursor, execute_values
+# pandas, openpyxl e boto3 são importados apenas nas rotas que os usam,
+# para que o arranque dos workers não pague o custo dessas bibliotecas.
 
 # --- Configuração da Aplicação ---
-# O nome 'application' é o padrão que o Elastic Beanstalk procura.
-application = app = Flask(__name__)
+app = Flask(__name__)
 
-app.secret_key = os.environ.get('SECRET_KEY')
-app.config['DATABASE_URL'] = os.environ.get('DATABASE_URL')
+# Orçamento (em segundos) para o tempo de 'import app' num processo novo.
+IMPORT_TIME_BUDGET = float(os.environ.get('IMPORT_TIME_BUDGET', '1.0'))
 
 # --- Configuração do S3 ---
 S3_BUCKET = os.environ.get("S3_BUCKET")
 S3_LOCATION = os.environ.get("S3_LOCATION")
-# As credenciais são lidas automaticamente pelo Boto3 a partir das variáveis de ambiente padrão do EB
-s3 = boto3.client("s3")
+_s3_client = None
+
+def get_s3():
+    """
+    Cria o cliente S3 na primeira utilização e reutiliza-o nas seguintes.
+    """
+    global _s3_client
+    if _s3_client is None:
+        import boto3 # Biblioteca da AWS
+        # As credenciais são lidas automaticamente pelo Boto3 a partir das variáveis de ambiente padrão do EB
+        _s3_client = boto3.client("s3")
+    return _s3_client
 
 def upload_file_to_s3(file, bucket_name, acl="public-read"):
     """
     Função para fazer o upload de um ficheiro para um bucket S3
     """
     try:
-        s3.upload_fileobj(
+        get_s3().upload_fileobj(
             file,
             bucket_name,
             file.filename,
@@ -44,11 +66,78 @@ def upload_file_to_s3(file, bucket_name, acl="public-read"):
         return {"error": str(e)}
     return {"url": f"{S3_LOCATION}{file.filename}"}
 
+def objeto_existe_s3(bucket_name, chave):
+    """
+    Indica se a chave já existe no bucket (HEAD, sem descarregar o objeto).
+    """
+    from botocore.exceptions import ClientError
+    try:
+        get_s3().head_object(Bucket=bucket_name, Key=chave)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return True
+
+class ArquivoComHash:
+    """
+    Ficheiro temporário de um upload que calcula o SHA-256 à medida que o Werkzeug escreve os dados recebidos,
+    para não ser preciso ler a imagem outra vez só para saber o hash.
+    """
+
+    def __init__(self, arquivo):
+        self._arquivo = arquivo
+        self.sha256 = hashlib.sha256()
+
+    def write(self, dados):
+        self.sha256.update(dados)
+        return self._arquivo.write(dados)
+
+    def __getattr__(self, nome):
+        return getattr(self._arquivo, nome)
+
+class RequestComHash(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return ArquivoComHash(super()._get_file_stream(total_content_length, content_type, filename, content_length))
+
+app.request_class = RequestComHash
+
+def chave_por_conteudo(file, prefixo):
+    """
+    Chave S3 endereçada pelo conteúdo (prefixo_<sha256>.<extensão>): a mesma imagem enviada duas vezes tem a mesma chave.
+    """
+    if isinstance(file.stream, ArquivoComHash):
+        digest = file.stream.sha256.hexdigest()
+    else:
+        sha256 = hashlib.sha256()
+        for bloco in iter(lambda: file.stream.read(1024 * 64), b''):
+            sha256.update(bloco)
+        file.stream.seek(0)
+        digest = sha256.hexdigest()
+    extensao = file.filename.rsplit('.', 1)[1].lower()
+    return secure_filename(f"{prefixo}/{digest}.{extensao}")
+
+def upload_por_conteudo(cursor, file, prefixo, tabela, coluna):
+    """
+    Guarda a imagem com chave_por_conteudo() e só faz o upload se ela ainda não existir: primeiro procura a chave
+    já ligada em 'tabela.coluna' (reenvio, resposta imediata) e depois no próprio bucket.
+    """
+    file.filename = chave_por_conteudo(file, prefixo)
+    cursor.execute(f"SELECT 1 FROM {tabela} WHERE {coluna} = %s LIMIT 1", (file.filename,))
+    if cursor.fetchone() is not None:
+        return {"url": f"{S3_LOCATION}{file.filename}", "existente": True}
+    try:
+        if objeto_existe_s3(S3_BUCKET, file.filename):
+            return {"url": f"{S3_LOCATION}{file.filename}", "existente": True}
+    except Exception as e:
+        print("Erro ao verificar o objeto no S3: ", e) # Na dúvida, envia
+    return upload_file_to_s3(file, S3_BUCKET)
+
 
 # --- Funções de Banco de Dados (PostgreSQL) ---
 def get_db():
     if 'db' not in g:
-        g.db = psycopg2.connect(app.config['DATABASE_URL'])
+        g.db = psycopg2.connect(app.config['DATABASE_URL'], connection_factory=app.config.get('DB_CONNECTION_FACTORY'))
     return g.db
 
 @app.teardown_appcontext
@@ -97,17 +186,172 @@ def init_db():
             FOREIGN KEY (usuario_id) REFERENCES usuarios(id), FOREIGN KEY (loja_id) REFERENCES lojas(id)
         );
     """
-    with app.app_context():
-        db = get_db()
-        cursor = db.cursor()
-        cursor.execute("SELECT to_regclass('public.usuarios');")
-        if cursor.fetchone()[0] is None:
-            cursor.execute(SCHEMA_SQL)
-            master_pass_hash = generate_password_hash('admin')
-            cursor.execute("INSERT INTO usuarios (usuario, senha_hash, tipo, nome_completo) VALUES (%s, %s, %s, %s)",
-                           ('master', master_pass_hash, 'master', 'Administrador Master'))
-            db.commit()
-        cursor.close()
+    # Alterações idempotentes, aplicadas também a bases já existentes a cada 'init-db'.
+    MIGRATIONS_SQL = """
+        ALTER TABLE campos_relatorio ADD COLUMN IF NOT EXISTS tipo TEXT DEFAULT 'texto';
+        ALTER TABLE campos_relatorio ADD COLUMN IF NOT EXISTS tamanho INTEGER DEFAULT 200;
+        -- Índices para a paginação por keyset das tabelas de gerenciamento
+        CREATE INDEX IF NOT EXISTS idx_lojas_razao_social_id ON lojas (razao_social, id);
+        CREATE INDEX IF NOT EXISTS idx_lojas_cnpj_id ON lojas ((COALESCE(cnpj, '')), id);
+        CREATE INDEX IF NOT EXISTS idx_lojas_cidade_id ON lojas ((COALESCE(cidade, '')), id);
+        CREATE INDEX IF NOT EXISTS idx_lojas_uf_id ON lojas ((COALESCE(uf, '')), id);
+        CREATE INDEX IF NOT EXISTS idx_lojas_grupo_id ON lojas (grupo_id);
+        CREATE INDEX IF NOT EXISTS idx_usuarios_promotora_nome_id ON usuarios ((COALESCE(nome_completo, '')), id) WHERE tipo = 'promotora';
+        CREATE INDEX IF NOT EXISTS idx_usuarios_promotora_telefone_id ON usuarios ((COALESCE(telefone, '')), id) WHERE tipo = 'promotora';
+        CREATE INDEX IF NOT EXISTS idx_usuarios_promotora_cidade_id ON usuarios ((COALESCE(cidade, '')), id) WHERE tipo = 'promotora';
+        -- Busca aproximada: trigramas sobre o texto sem acentos e sobre os dígitos de CNPJ/telefone.
+        -- unaccent() não é IMMUTABLE, por isso os índices usam o invólucro f_unaccent().
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE EXTENSION IF NOT EXISTS unaccent;
+        CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text AS $$
+            SELECT public.unaccent('public.unaccent', $1)
+        $$ LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT;
+        CREATE INDEX IF NOT EXISTS idx_lojas_busca_trgm ON lojas
+            USING gin (f_unaccent(lower(razao_social || ' ' || COALESCE(bandeira, '') || ' ' || COALESCE(cidade, ''))) gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS idx_lojas_cnpj_digitos_trgm ON lojas
+            USING gin (regexp_replace(COALESCE(cnpj, ''), '\\D', '', 'g') gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS idx_usuarios_nome_trgm ON usuarios
+            USING gin (f_unaccent(lower(COALESCE(nome_completo, ''))) gin_trgm_ops) WHERE tipo = 'promotora';
+        CREATE INDEX IF NOT EXISTS idx_usuarios_telefone_digitos_trgm ON usuarios
+            USING gin (regexp_replace(COALESCE(telefone, ''), '\\D', '', 'g') gin_trgm_ops) WHERE tipo = 'promotora';
+        -- Coordenadas das lojas e índice em grelha (células de GEO_CELULA_GRAUS graus) para a loja mais próxima
+        ALTER TABLE lojas ADD COLUMN IF NOT EXISTS latitude DOUBLE PRECISION;
+        ALTER TABLE lojas ADD COLUMN IF NOT EXISTS longitude DOUBLE PRECISION;
+        ALTER TABLE lojas ADD COLUMN IF NOT EXISTS geo_celula BIGINT GENERATED ALWAYS AS (
+            floor((latitude + 90) / 0.05)::bigint * 10000 + floor((longitude + 180) / 0.05)::bigint
+        ) STORED;
+        CREATE INDEX IF NOT EXISTS idx_lojas_geo_celula ON lojas (geo_celula);
+        -- Conformidade: cache por dia fechado da matriz associação x dia (relatório e check-in feitos ou não)
+        CREATE TABLE IF NOT EXISTS conformidade_dia (
+            dia DATE NOT NULL, usuario_id INTEGER NOT NULL, loja_id INTEGER NOT NULL,
+            relatorio BOOLEAN NOT NULL, checkin BOOLEAN NOT NULL,
+            PRIMARY KEY (dia, usuario_id, loja_id)
+        );
+        CREATE TABLE IF NOT EXISTS conformidade_dias_calculados (
+            dia DATE PRIMARY KEY, calculado_em TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+        -- Início de cada associação e data de inativação da promotora: os dias fora desse intervalo não são esperados.
+        -- Associações e inativações anteriores a estas colunas ficam com NULL (associada desde sempre, sem data de saída).
+        ALTER TABLE promotora_lojas ADD COLUMN IF NOT EXISTS criado_em TIMESTAMP;
+        ALTER TABLE promotora_lojas ALTER COLUMN criado_em SET DEFAULT NOW();
+        ALTER TABLE usuarios ADD COLUMN IF NOT EXISTS inativo_desde TIMESTAMP;
+        -- Associações de uma loja (filtro por loja da conformidade): a chave primária começa por usuario_id.
+        CREATE INDEX IF NOT EXISTS idx_promotora_lojas_loja ON promotora_lojas (loja_id);
+        -- Exclusão de campos e grupos: somem logo (removido_em) e os dados são apagados em lotes por um worker
+        ALTER TABLE campos_relatorio ADD COLUMN IF NOT EXISTS removido_em TIMESTAMP;
+        ALTER TABLE grupos ADD COLUMN IF NOT EXISTS removido_em TIMESTAMP;
+        -- Grupos removidos antes de libertarem o nome (UNIQUE) ao serem apagados
+        UPDATE grupos SET nome = nome || ' [removido #' || id || ']' WHERE removido_em IS NOT NULL AND nome NOT LIKE '% [removido #%]';
+        CREATE TABLE IF NOT EXISTS exclusoes_pendentes (
+            id SERIAL PRIMARY KEY, tipo TEXT NOT NULL, alvo_id INTEGER NOT NULL, descricao TEXT NOT NULL,
+            total BIGINT, removidos BIGINT NOT NULL DEFAULT 0,
+            criado_em TIMESTAMP NOT NULL DEFAULT NOW(), concluido_em TIMESTAMP, erro TEXT
+        );
+        CREATE TABLE IF NOT EXISTS horas_loja_dia (
+            dia DATE NOT NULL, usuario_id INTEGER NOT NULL, loja_id INTEGER NOT NULL,
+            visitas INTEGER NOT NULL, visitas_sem_saida INTEGER NOT NULL, saidas_sem_entrada INTEGER NOT NULL,
+            horas DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (dia, usuario_id, loja_id)
+        );
+        CREATE TABLE IF NOT EXISTS horas_dias_calculados (
+            dia DATE PRIMARY KEY, calculado_em TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+    """
+    # Índices das tabelas que crescem com os envios. São criados com CONCURRENTLY, fora da transação do
+    # 'init-db', para que o deploy não bloqueie os envios de relatórios e check-ins enquanto são construídos.
+    INDICES_CONCORRENTES = [
+        # Horas em loja: cache por dia fechado do pareamento de check-in/checkout
+        ('idx_checkins_data_hora', 'checkins (data_hora)'),
+        # Relatório diário: pivot feito no banco a partir dos relatórios do dia
+        ('idx_relatorios_data', 'relatorios (data)'),
+        ('idx_dados_relatorio_relatorio_id', 'dados_relatorio (relatorio_id)'),
+        # Históricos por promotora (formulário e check-in), ordenados pela data mais recente
+        ('idx_relatorios_usuario_data_hora', 'relatorios (usuario_id, data_hora)'),
+        ('idx_checkins_usuario_data_hora', 'checkins (usuario_id, data_hora)'),
+        # Imagens guardadas por hash do conteúdo: procura de uma chave já enviada
+        ('idx_imagens_enviadas_nota_img', 'imagens_enviadas (nota_img)'),
+        ('idx_checkins_imagem_path', 'checkins (imagem_path)'),
+        # Exclusão de campos: lotes de dados_relatorio por campo_id
+        ('idx_dados_relatorio_campo_id', 'dados_relatorio (campo_id)'),
+    ]
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute("SELECT to_regclass('usuarios');")
+    if cursor.fetchone()[0] is None:
+        cursor.execute(SCHEMA_SQL)
+        master_pass_hash = generate_password_hash('admin')
+        cursor.execute("INSERT INTO usuarios (usuario, senha_hash, tipo, nome_completo) VALUES (%s, %s, %s, %s)",
+                       ('master', master_pass_hash, 'master', 'Administrador Master'))
+    cursor.execute(MIGRATIONS_SQL)
+    db.commit()
+    db.autocommit = True
+    for nome, definicao in INDICES_CONCORRENTES:
+        cursor.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (nome,))
+        existente = cursor.fetchone()
+        if existente and existente[0]:
+            continue
+        if existente:
+            # Um CREATE INDEX CONCURRENTLY interrompido deixa o índice inválido: recomeça do zero.
+            cursor.execute(f"DROP INDEX CONCURRENTLY {nome}")
+        cursor.execute(f"CREATE INDEX CONCURRENTLY {nome} ON {definicao}")
+    db.autocommit = False
+    cursor.close()
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Cria o esquema da base de dados e o utilizador master."""
+    init_db()
+    click.echo('Base de dados inicializada.')
+
+@app.cli.command('purgar-exclusoes')
+def purgar_exclusoes_command():
+    """Executa agora, em primeiro plano, as exclusões de campos e grupos pendentes."""
+    concluidas, restantes = purga.processar_pendentes()
+    click.echo(f'Exclusões concluídas: {concluidas}. Por concluir: {restantes}.')
+
+@app.cli.command('calcular-conformidade')
+@click.option('--dias', type=int, default=90, help='Quantos dias fechados (até ontem) calcular.')
+def calcular_conformidade_command(dias):
+    """Preenche a cache da matriz de conformidade para os últimos dias fechados (tarefa noturna, ver .ebextensions)."""
+    ontem = date.today() - timedelta(days=1)
+    db = get_db()
+    cursor = db.cursor()
+    # O cron corre em todas as instâncias; só uma calcula, as outras encontram os dias já guardados.
+    cursor.execute("SELECT pg_try_advisory_lock(%s)", (CONFORMIDADE_LOCK,))
+    if not cursor.fetchone()[0]:
+        click.echo('Cálculo da conformidade já em curso noutro processo.')
+        return
+    try:
+        garantir_conformidade_em_cache(db, ontem - timedelta(days=dias - 1), ontem)
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (CONFORMIDADE_LOCK,))
+        db.commit()
+    click.echo(f'Conformidade calculada até {ontem.isoformat()}.')
+
+def medir_import():
+    """Importa a app num processo novo e devolve (segundos, módulos pesados que o import carregou)."""
+    codigo = ("import sys, time; t = time.perf_counter(); import app; d = time.perf_counter() - t; "
+              "print(d); print(','.join(m for m in ('pandas', 'boto3', 'openpyxl') if m in sys.modules))")
+    resultado = subprocess.run([sys.executable, '-c', codigo], cwd=app.root_path, capture_output=True, text=True)
+    if resultado.returncode != 0:
+        raise RuntimeError(f"Falha ao importar a aplicação: {resultado.stderr.strip()}")
+    linhas = resultado.stdout.splitlines()
+    return float(linhas[-2]), [m for m in linhas[-1].split(',') if m]
+
+@app.cli.command('check-import-time')
+@click.option('--budget', type=float, default=None, help='Tempo máximo em segundos (padrão: IMPORT_TIME_BUDGET).')
+def check_import_time_command(budget):
+    """Mede o tempo de 'import app' num processo novo e falha se exceder o orçamento."""
+    budget = budget if budget is not None else IMPORT_TIME_BUDGET
+    try:
+        duracao, pesados = medir_import()
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"import app: {duracao:.3f}s (orçamento: {budget:.3f}s)")
+    if pesados:
+        raise click.ClickException(f"Módulos pesados carregados no import: {', '.join(pesados)}")
+    if duracao > budget:
+        raise click.ClickException("Tempo de import acima do orçamento.")
 
 # --- ROTAS ---
 @app.route('/', methods=['GET', 'POST'])
@@ -152,6 +396,17 @@ def get_promotora_lojas(usuario_id):
     cursor.close()
     return lojas
 
+# Grupo da loja, ignorando um grupo removido que ainda espera a purga (a loja só perde o grupo_id nos lotes do worker)
+LOJA_GRUPO_ATIVO_SQL = "SELECT g.id AS grupo_id FROM lojas l LEFT JOIN grupos g ON g.id = l.grupo_id AND g.removido_em IS NULL WHERE l.id = %s"
+
+def atualizar_lojas_promotora(cursor, usuario_id, loja_ids):
+    """Substitui as lojas da promotora sem recriar as associações mantidas, que guardam a data de início (criado_em)."""
+    loja_ids = [int(loja_id) for loja_id in loja_ids]
+    cursor.execute("DELETE FROM promotora_lojas WHERE usuario_id = %s AND NOT (loja_id = ANY(%s))", (usuario_id, loja_ids))
+    if loja_ids:
+        execute_values(cursor, "INSERT INTO promotora_lojas (usuario_id, loja_id) VALUES %s ON CONFLICT DO NOTHING",
+                       [(usuario_id, loja_id) for loja_id in loja_ids])
+
 @app.route('/formulario', methods=['GET', 'POST'])
 def formulario():
     if 'user_type' not in session or session['user_type'] != 'promotora': return redirect(url_for('login'))
@@ -169,12 +424,12 @@ def formulario():
         if not loja_id_selecionada:
             flash("É necessário selecionar uma loja para enviar o relatório.", "danger")
             return redirect(url_for('formulario'))
-        cursor.execute("SELECT grupo_id FROM lojas WHERE id = %s", (loja_id_selecionada,))
+        cursor.execute(LOJA_GRUPO_ATIVO_SQL, (loja_id_selecionada,))
         loja_selecionada = cursor.fetchone()
         if not loja_selecionada or not loja_selecionada['grupo_id']:
             flash("A loja selecionada não pertence a um grupo com relatório configurado.", "warning")
             return redirect(url_for('formulario'))
-        cursor.execute("SELECT * FROM campos_relatorio WHERE grupo_id = %s", (loja_selecionada['grupo_id'],))
+        cursor.execute("SELECT * FROM campos_relatorio WHERE grupo_id = %s AND removido_em IS NULL", (loja_selecionada['grupo_id'],))
         campos = cursor.fetchall()
         cursor.execute("INSERT INTO relatorios (usuario_id, loja_id, data, data_hora) VALUES (%s, %s, %s, %s) RETURNING id", (usuario_id, loja_id_selecionada, str(datetime.today().date()), datetime.now()))
         relatorio_id = cursor.fetchone()['id']
@@ -182,6 +437,7 @@ def formulario():
             valor_enviado = request.form.get(f"campo_{campo['id']}")
             if valor_enviado:
                 cursor.execute("INSERT INTO dados_relatorio (relatorio_id, campo_id, valor) VALUES (%s, %s, %s)", (relatorio_id, campo['id'], valor_enviado))
+        notificar_painel(cursor, 'relatorio')
         db.commit()
         cursor.close()
         flash("Relatório enviado com sucesso!", "success")
@@ -191,17 +447,17 @@ def formulario():
         loja_id_para_campos = lojas_associadas[0]['id']
     campos = []
     if loja_id_para_campos:
-        cursor.execute("SELECT grupo_id FROM lojas WHERE id = %s", (loja_id_para_campos,))
+        cursor.execute(LOJA_GRUPO_ATIVO_SQL, (loja_id_para_campos,))
         loja_atual = cursor.fetchone()
         if loja_atual and loja_atual['grupo_id']:
-            cursor.execute("SELECT * FROM campos_relatorio WHERE grupo_id = %s ORDER BY id", (loja_atual['grupo_id'],))
+            cursor.execute("SELECT * FROM campos_relatorio WHERE grupo_id = %s AND removido_em IS NULL ORDER BY id", (loja_atual['grupo_id'],))
             campos = cursor.fetchall()
     historico_query = "SELECT r.id, r.data_hora, l.razao_social FROM relatorios r JOIN lojas l ON r.loja_id = l.id WHERE r.usuario_id = %s ORDER BY r.data_hora DESC LIMIT 10"
     cursor.execute(historico_query, (usuario_id,))
     reports = cursor.fetchall()
     historico_relatorios = []
     for report in reports:
-        cursor.execute("SELECT cr.label_campo, dr.valor FROM dados_relatorio dr JOIN campos_relatorio cr ON dr.campo_id = cr.id WHERE dr.relatorio_id = %s", (report['id'],))
+        cursor.execute("SELECT cr.label_campo, dr.valor FROM dados_relatorio dr JOIN campos_relatorio cr ON dr.campo_id = cr.id WHERE dr.relatorio_id = %s AND cr.removido_em IS NULL", (report['id'],))
         dados = cursor.fetchall()
         historico_relatorios.append({'info': report, 'dados': dados})
     cursor.close()
@@ -223,14 +479,7 @@ def enviar_imagem():
         if not loja_id_selecionada or not imagem_file:
             flash("É necessário selecionar uma loja e um arquivo.", "danger")
             return redirect(url_for('enviar_imagem'))
-        cursor.execute("SELECT cnpj FROM lojas WHERE id = %s", (loja_id_selecionada,))
-        loja_selecionada = cursor.fetchone()
-        timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')[:-3]
-        cnpj = loja_selecionada['cnpj'] if loja_selecionada and loja_selecionada['cnpj'] else 'sem_cnpj'
-        extensao = imagem_file.filename.rsplit('.', 1)[1].lower()
-        novo_nome = f"imagens_enviadas/{cnpj}_{timestamp}.{extensao}"
-        imagem_file.filename = secure_filename(novo_nome)
-        output = upload_file_to_s3(imagem_file, S3_BUCKET)
+        output = upload_por_conteudo(cursor, imagem_file, 'imagens_enviadas', 'imagens_enviadas', 'nota_img')
         if "error" in output:
             flash(f"Erro ao enviar ficheiro: {output['error']}", "danger")
             return redirect(url_for('enviar_imagem'))
@@ -262,15 +511,12 @@ def checkin():
         if not all([loja_id_selecionada, tipo, imagem_file]):
             flash('Todos os campos são obrigatórios.', 'warning')
             return redirect(url_for('checkin'))
-        timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-        extensao = imagem_file.filename.rsplit('.', 1)[1].lower()
-        nome_arquivo = f"checkins/{tipo}_{usuario_id}_{timestamp}.{extensao}"
-        imagem_file.filename = secure_filename(nome_arquivo)
-        output = upload_file_to_s3(imagem_file, S3_BUCKET)
+        output = upload_por_conteudo(cursor, imagem_file, 'checkins', 'checkins', 'imagem_path')
         if "error" in output:
             flash(f"Erro ao enviar imagem: {output['error']}", "danger")
             return redirect(url_for('checkin'))
         cursor.execute("INSERT INTO checkins (usuario_id, loja_id, tipo, data_hora, latitude, longitude, imagem_path) VALUES (%s, %s, %s, %s, %s, %s, %s)", (usuario_id, loja_id_selecionada, tipo, datetime.now(), latitude, longitude, imagem_file.filename))
+        notificar_painel(cursor, 'checkin', tipo)
         db.commit()
         flash(f'{tipo.capitalize()} registado com sucesso!', 'success')
         return redirect(url_for('checkin'))
@@ -288,51 +534,227 @@ def admin_redirect():
     if 'user_type' not in session or session['user_type'] != 'master': return redirect(url_for('login'))
     return redirect(url_for('dashboard'))
 
+# --- DASHBOARD AO VIVO (LISTEN/NOTIFY + server-sent events) ---
+CANAL_PAINEL = 'painel'
+# De quanto em quanto tempo o ouvinte recalcula os contadores a partir do banco (corrige desvios e a virada do dia).
+PAINEL_RESYNC_SEGUNDOS = 300
+# Duração máxima de uma ligação SSE; o EventSource volta a ligar sozinho e a thread do servidor fica livre entretanto.
+PAINEL_STREAM_SEGUNDOS = 600
+# Cada stream aberto prende uma thread do waitress; acima deste limite (por processo) o stream responde 503
+# e a página passa a consultar /admin/dashboard/dados a cada PAINEL_POLL_SEGUNDOS.
+PAINEL_MAX_STREAMS = int(os.environ.get('PAINEL_MAX_STREAMS', 8))
+PAINEL_POLL_SEGUNDOS = 30
+
+def notificar_painel(cursor, evento, tipo=None):
+    """Avisa os dashboards abertos. O NOTIFY só é entregue se a transação fizer commit."""
+    payload = json.dumps({'evento': evento, 'tipo': tipo, 'dia': date.today().isoformat()})
+    cursor.execute("SELECT pg_notify(%s, %s)", (CANAL_PAINEL, payload))
+
+def carregar_painel(cursor):
+    """Lê do banco o estado completo do dashboard para hoje."""
+    hoje = date.today()
+    cursor.execute("SELECT COUNT(id) as total FROM usuarios WHERE tipo = 'promotora' AND ativo = 1")
+    total_promotoras = cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(id) as total FROM lojas")
+    total_lojas = cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(id) as total FROM relatorios WHERE data = %s", (hoje,))
+    relatorios_hoje = cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(id) as total FROM checkins WHERE data_hora >= %s::date AND data_hora < %s::date + 1", (hoje, hoje))
+    checkins_hoje = cursor.fetchone()[0]
+    cursor.execute("SELECT data as dia, COUNT(id) as total FROM relatorios WHERE data >= %s::date - 6 GROUP BY dia ORDER BY dia ASC", (hoje,))
+    por_dia = {linha[0]: linha[1] for linha in cursor.fetchall()}
+    cursor.execute("SELECT tipo, COUNT(id) as total FROM checkins WHERE data_hora >= %s::date AND data_hora < %s::date + 1 GROUP BY tipo", (hoje, hoje))
+    checkins_por_tipo = {linha[0]: linha[1] for linha in cursor.fetchall()}
+    dias = [hoje - timedelta(days=n) for n in range(6, -1, -1)]
+    return {'dia': hoje.isoformat(), 'total_promotoras': total_promotoras, 'total_lojas': total_lojas,
+            'relatorios_hoje': relatorios_hoje, 'checkins_hoje': checkins_hoje,
+            'relatorios_por_dia': {d.isoformat(): por_dia.get(d, 0) for d in dias}, 'checkins_por_tipo': checkins_por_tipo}
+
+def dados_painel(estado):
+    """Converte o estado nos valores usados pelo dashboard.html (e enviados pelo stream)."""
+    return {
+        'total_promotoras': estado['total_promotoras'], 'total_lojas': estado['total_lojas'],
+        'relatorios_hoje': estado['relatorios_hoje'], 'checkins_hoje': estado['checkins_hoje'],
+        'report_labels': [datetime.strptime(d, '%Y-%m-%d').strftime('%d/%m') for d in estado['relatorios_por_dia']],
+        'report_data': list(estado['relatorios_por_dia'].values()),
+        'checkin_labels': [tipo.capitalize() for tipo in estado['checkins_por_tipo']],
+        'checkin_data': list(estado['checkins_por_tipo'].values()),
+    }
+
+class PainelAoVivo:
+    """
+    Um único ouvinte LISTEN por processo. Mantém os contadores do dashboard em memória,
+    aplica cada NOTIFY como incremento e distribui o resultado pelas filas dos clientes SSE,
+    de modo que o número de dashboards abertos não acrescenta consultas ao banco.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._assinantes = set()
+        self._estado = None
+        self._thread = None
+
+    def iniciar(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._executar, name='painel-listen', daemon=True)
+                self._thread.start()
+
+    def estado(self, cursor):
+        """
+        Dados atuais do dashboard; na primeira chamada do processo carrega-os com o cursor do pedido.
+        Com PAINEL_AO_VIVO desligado na configuração (verificação de planos) lê sempre do banco, sem abrir o ouvinte.
+        """
+        if not app.config.get('PAINEL_AO_VIVO', True):
+            return dados_painel(carregar_painel(cursor))
+        self.iniciar()
+        with self._lock:
+            estado = self._estado
+        if estado is None:
+            estado = carregar_painel(cursor)
+            with self._lock:
+                if self._estado is None:
+                    self._estado = estado
+        return dados_painel(estado)
+
+    def assinar(self):
+        """Fila de atualizações de um cliente SSE, ou None se o processo já tem PAINEL_MAX_STREAMS streams abertos."""
+        fila = queue.Queue(maxsize=50)
+        with self._lock:
+            if len(self._assinantes) >= PAINEL_MAX_STREAMS:
+                return None
+            self._assinantes.add(fila)
+        return fila
+
+    def cancelar(self, fila):
+        with self._lock:
+            self._assinantes.discard(fila)
+
+    def _publicar(self, estado):
+        with self._lock:
+            self._estado = estado
+            mensagem = json.dumps(dados_painel(estado))
+            assinantes = list(self._assinantes)
+        for fila in assinantes:
+            try:
+                fila.put_nowait(mensagem)
+            except queue.Full:
+                pass # Cliente lento: perde esta atualização e recebe a seguinte
+
+    def _aplicar(self, evento):
+        """Aplica um NOTIFY como incremento; devolve False quando é preciso recarregar do banco (ex.: virada do dia)."""
+        with self._lock:
+            if self._estado is None or evento.get('dia') != self._estado['dia']:
+                return False
+            estado = json.loads(json.dumps(self._estado))
+        if evento.get('evento') == 'relatorio':
+            estado['relatorios_hoje'] += 1
+            estado['relatorios_por_dia'][estado['dia']] = estado['relatorios_por_dia'].get(estado['dia'], 0) + 1
+        elif evento.get('evento') == 'checkin':
+            estado['checkins_hoje'] += 1
+            tipo = evento.get('tipo') or ''
+            estado['checkins_por_tipo'][tipo] = estado['checkins_por_tipo'].get(tipo, 0) + 1
+        self._publicar(estado)
+        return True
+
+    def _executar(self):
+        while True:
+            conexao = None
+            try:
+                conexao = psycopg2.connect(app.config['DATABASE_URL'])
+                conexao.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                cursor = conexao.cursor()
+                cursor.execute(f"LISTEN {CANAL_PAINEL}")
+                # Recarrega depois do LISTEN para não perder eventos ocorridos enquanto esteve desligado.
+                self._publicar(carregar_painel(cursor))
+                ultimo_sync = time.monotonic()
+                while True:
+                    recarregar = time.monotonic() - ultimo_sync > PAINEL_RESYNC_SEGUNDOS or self._estado['dia'] != date.today().isoformat()
+                    if select.select([conexao], [], [], 5) != ([], [], []):
+                        conexao.poll()
+                        while conexao.notifies:
+                            notificacao = conexao.notifies.pop(0)
+                            if not self._aplicar(json.loads(notificacao.payload)):
+                                recarregar = True
+                    if recarregar:
+                        self._publicar(carregar_painel(cursor))
+                        ultimo_sync = time.monotonic()
+            except Exception as e:
+                print("Erro no ouvinte do dashboard: ", e)
+                time.sleep(5)
+            finally:
+                if conexao is not None:
+                    conexao.close()
+
+painel = PainelAoVivo()
+
 @app.route('/admin/dashboard')
 def dashboard():
     if 'user_type' not in session or session['user_type'] != 'master': return redirect(url_for('login'))
     db = get_db()
-    cursor = db.cursor(cursor_factory=DictCursor)
-    today = datetime.now().strftime('%Y-%m-%d')
-    cursor.execute("SELECT COUNT(id) as total FROM usuarios WHERE tipo = 'promotora' AND ativo = 1")
-    total_promotoras = cursor.fetchone()['total']
-    cursor.execute("SELECT COUNT(id) as total FROM lojas")
-    total_lojas = cursor.fetchone()['total']
-    cursor.execute("SELECT COUNT(id) as total FROM relatorios WHERE data = %s", (today,))
-    relatorios_hoje = cursor.fetchone()['total']
-    cursor.execute("SELECT COUNT(id) as total FROM checkins WHERE data_hora::date = %s", (today,))
-    checkins_hoje = cursor.fetchone()['total']
-    cursor.execute("SELECT data_hora::date as dia, COUNT(id) as total FROM relatorios WHERE data_hora::date >= NOW() - INTERVAL '6 days' GROUP BY dia ORDER BY dia ASC")
-    reports_by_day = cursor.fetchall()
-    cursor.execute("SELECT tipo, COUNT(id) as total FROM checkins WHERE data_hora::date = %s GROUP BY tipo", (today,))
-    checkins_by_type = cursor.fetchall()
-    report_labels = [r['dia'].strftime('%d/%m') for r in reports_by_day]
-    report_data = [r['total'] for r in reports_by_day]
-    checkin_labels = [r['tipo'].capitalize() for r in checkins_by_type]
-    checkin_data = [r['total'] for r in checkins_by_type]
-    cursor.close()
-    return render_template('dashboard.html', title="Dashboard", total_promotoras=total_promotoras, total_lojas=total_lojas, relatorios_hoje=relatorios_hoje, checkins_hoje=checkins_hoje, report_labels=report_labels, report_data=report_data, checkin_labels=checkin_labels, checkin_data=checkin_data)
+    cursor = db.cursor()
+    dados = painel.estado(cursor)
+    cursor.close()
+    return render_template('dashboard.html', title="Dashboard", poll_segundos=PAINEL_POLL_SEGUNDOS, **dados)
+
+@app.route('/admin/dashboard/dados')
+def dashboard_dados():
+    if 'user_type' not in session or session['user_type'] != 'master': return jsonify({'erro': 'Não autorizado'}), 403
+    db = get_db()
+    cursor = db.cursor()
+    dados = painel.estado(cursor)
+    cursor.close()
+    return jsonify(dados)
+
+@app.route('/admin/dashboard/stream')
+def dashboard_stream():
+    if 'user_type' not in session or session['user_type'] != 'master': return Response(status=403)
+    fila = painel.assinar()
+    if fila is None:
+        # O EventSource não volta a ligar depois de um 503; a página passa a consultar dashboard_dados.
+        return Response(status=503, headers={'Retry-After': str(PAINEL_POLL_SEGUNDOS)})
+    try:
+        db = get_db()
+        cursor = db.cursor()
+        inicial = painel.estado(cursor)
+        cursor.close()
+    except Exception:
+        painel.cancelar(fila)
+        raise
+
+    def gerar():
+        try:
+            yield f"retry: 3000\ndata: {json.dumps(inicial)}\n\n"
+            fim = time.monotonic() + PAINEL_STREAM_SEGUNDOS
+            while time.monotonic() < fim:
+                try:
+                    mensagem = fila.get(timeout=15)
+                except queue.Empty:
+                    yield ": ping\n\n" # Mantém a ligação aberta através de proxies
+                    continue
+                yield f"data: {mensagem}\n\n"
+        finally:
+            painel.cancelar(fila)
+
+    return Response(gerar(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/admin/gerenciamento')
 def gerenciamento():
     if 'user_type' not in session or session['user_type'] != 'master': return redirect(url_for('login'))
     db = get_db()
     cursor = db.cursor(cursor_factory=DictCursor)
-    cursor.execute("SELECT * FROM grupos ORDER BY nome")
+    # As tabelas de lojas e promotoras são carregadas sob demanda via /api/admin/lojas e /api/admin/promotoras.
+    cursor.execute("SELECT * FROM grupos WHERE removido_em IS NULL ORDER BY nome")
     grupos = cursor.fetchall()
-    cursor.execute("SELECT l.*, g.nome as grupo_nome FROM lojas l LEFT JOIN grupos g ON l.grupo_id = g.id ORDER BY l.razao_social")
-    lojas_all = cursor.fetchall()
-    cursor.execute("SELECT u.*, COUNT(pl.loja_id) as total_lojas FROM usuarios u LEFT JOIN promotora_lojas pl ON u.id = pl.usuario_id WHERE u.tipo = 'promotora' GROUP BY u.id ORDER BY u.nome_completo")
-    promotoras = cursor.fetchall()
     cursor.close()
-    return render_template('gerenciamento.html', title="Gerenciamento", lojas=lojas_all, promotoras=promotoras, grupos=grupos, lojas_all=lojas_all)
+    return render_template('gerenciamento.html', title="Gerenciamento", grupos=grupos)
 
 @app.route('/admin/grupos')
 def gerenciar_grupos():
     if 'user_type' not in session or session['user_type'] != 'master': return redirect(url_for('login'))
     db = get_db()
     cursor = db.cursor(cursor_factory=DictCursor)
-    cursor.execute("SELECT * FROM grupos ORDER BY nome")
+    cursor.execute("SELECT * FROM grupos WHERE removido_em IS NULL ORDER BY nome")
     grupos = cursor.fetchall()
     cursor.close()
     return render_template('grupos.html', title="Gerir Grupos", grupos=grupos)
@@ -360,24 +782,51 @@ def delete_grupo(id):
     if 'user_type' not in session or session['user_type'] != 'master': return redirect(url_for('login'))
     db = get_db()
     cursor = db.cursor()
-    cursor.execute("UPDATE lojas SET grupo_id = NULL WHERE grupo_id = %s", (id,))
-    cursor.execute("DELETE FROM campos_relatorio WHERE grupo_id = %s", (id,))
-    cursor.execute("DELETE FROM grupos WHERE id = %s", (id,))
+    # Some já das telas; lojas, campos e dados são apagados em lotes pelo worker de exclusão.
+    # O nome é libertado logo (UNIQUE), para que um grupo novo com o mesmo nome possa ser criado durante a purga.
+    cursor.execute("""
+        UPDATE grupos g SET removido_em = NOW(), nome = g.nome || ' [removido #' || g.id || ']'
+        FROM grupos antigo WHERE antigo.id = g.id AND g.id = %s AND g.removido_em IS NULL RETURNING antigo.nome
+    """, (id,))
+    grupo = cursor.fetchone()
+    if grupo:
+        cursor.execute("UPDATE campos_relatorio SET removido_em = NOW() WHERE grupo_id = %s AND removido_em IS NULL", (id,))
+        agendar_exclusao(cursor, 'grupo', id, f"Grupo '{grupo[0]}'")
     db.commit()
     cursor.close()
-    flash("Grupo removido com sucesso.", "success")
+    purga.acordar()
+    flash("Grupo removido com sucesso. As lojas e os dados associados estão sendo desvinculados em segundo plano.", "success")
     return redirect(url_for('gerenciar_grupos'))
 
+@app.route('/api/admin/exclusoes')
+def api_exclusoes():
+    if 'user_type' not in session or session['user_type'] != 'master': return jsonify({'erro': 'Não autorizado'}), 403
+    db = get_db()
+    cursor = db.cursor(cursor_factory=DictCursor)
+    cursor.execute("""
+        SELECT id, tipo, descricao, total, removidos, criado_em, concluido_em, erro FROM exclusoes_pendentes
+        WHERE concluido_em IS NULL OR concluido_em > NOW() - INTERVAL '1 day' ORDER BY id DESC LIMIT 20
+    """)
+    exclusoes = [dict(linha) for linha in cursor.fetchall()]
+    cursor.close()
+    if any(exclusao['concluido_em'] is None for exclusao in exclusoes):
+        # Retoma exclusões deixadas a meio por um reinício (o cartão de progresso consulta esta rota enquanto houver alguma).
+        purga.iniciar()
+    for exclusao in exclusoes:
+        exclusao['criado_em'] = exclusao['criado_em'].strftime('%d/%m/%Y %H:%M')
+        exclusao['concluido_em'] = exclusao['concluido_em'].strftime('%d/%m/%Y %H:%M') if exclusao['concluido_em'] else None
+    return jsonify({'itens': exclusoes})
+
 @app.route('/admin/grupo/<int:id>')
 def detalhe_grupo(id):
     if 'user_type' not in session or session['user_type'] != 'master': return redirect(url_for('login'))
     db = get_db()
     cursor = db.cursor(cursor_factory=DictCursor)
-    cursor.execute("SELECT * FROM grupos WHERE id = %s", (id,))
+    cursor.execute("SELECT * FROM grupos WHERE id = %s AND removido_em IS NULL", (id,))
     grupo = cursor.fetchone()
     if not grupo:
         return redirect(url_for('gerenciar_grupos'))
-    cursor.execute("SELECT * FROM campos_relatorio WHERE grupo_id = %s ORDER BY label_campo", (id,))
+    cursor.execute("SELECT * FROM campos_relatorio WHERE grupo_id = %s AND removido_em IS NULL ORDER BY label_campo", (id,))
     campos = cursor.fetchall()
     cursor.close()
     return render_template('grupo_detalhe.html', title=f"Grupo {grupo['nome']}", grupo=grupo, campos=campos)
@@ -410,15 +859,14 @@ def delete_campo(campo_id):
     if 'user_type' not in session or session['user_type'] != 'master': return redirect(url_for('login'))
     db = get_db()
     cursor = db.cursor(cursor_factory=DictCursor)
-    cursor.execute("SELECT grupo_id FROM campos_relatorio WHERE id = %s", (campo_id,))
+    cursor.execute("UPDATE campos_relatorio SET removido_em = NOW() WHERE id = %s AND removido_em IS NULL RETURNING grupo_id, label_campo", (campo_id,))
     campo = cursor.fetchone()
     if campo:
-        cursor_dml = db.cursor()
-        cursor_dml.execute("DELETE FROM dados_relatorio WHERE campo_id = %s", (campo_id,))
-        cursor_dml.execute("DELETE FROM campos_relatorio WHERE id = %s", (campo_id,))
+        agendar_exclusao(cursor, 'campo', campo_id, f"Campo '{campo['label_campo']}'")
         db.commit()
-        cursor_dml.close()
-        flash("Campo removido.", "success")
+        cursor.close()
+        purga.acordar()
+        flash("Campo removido. Os dados já enviados estão sendo apagados em segundo plano.", "success")
         return redirect(url_for('detalhe_grupo', id=campo['grupo_id']))
     cursor.close()
     return redirect(url_for('gerenciar_grupos'))
@@ -429,8 +877,9 @@ def add_loja():
     db = get_db()
     cursor = db.cursor()
     try:
-        cursor.execute("INSERT INTO lojas (razao_social, bandeira, cnpj, av_rua, cidade, uf, grupo_id) VALUES (%s, %s, %s, %s, %s, %s, %s)",
-                   (request.form['razao_social'], request.form['bandeira'], request.form['cnpj'], request.form['av_rua'], request.form['cidade'], request.form['uf'], request.form['grupo_id']))
+        cursor.execute("INSERT INTO lojas (razao_social, bandeira, cnpj, av_rua, cidade, uf, grupo_id, latitude, longitude) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                   (request.form['razao_social'], request.form['bandeira'], request.form['cnpj'], request.form['av_rua'], request.form['cidade'], request.form['uf'], request.form['grupo_id'],
+                    coordenada(request.form.get('latitude'), 90), coordenada(request.form.get('longitude'), 180)))
         db.commit()
         flash("Loja adicionada com sucesso!", "success")
     except psycopg2.IntegrityError:
@@ -447,15 +896,16 @@ def edit_loja(id):
     cursor = db.cursor(cursor_factory=DictCursor)
     if request.method == 'POST':
         cursor_dml = db.cursor()
-        cursor_dml.execute("UPDATE lojas SET razao_social = %s, bandeira = %s, cnpj = %s, av_rua = %s, cidade = %s, uf = %s, grupo_id = %s WHERE id = %s",
-                   (request.form['razao_social'], request.form['bandeira'], request.form['cnpj'], request.form['av_rua'], request.form['cidade'], request.form['uf'], request.form['grupo_id'], id))
+        cursor_dml.execute("UPDATE lojas SET razao_social = %s, bandeira = %s, cnpj = %s, av_rua = %s, cidade = %s, uf = %s, grupo_id = %s, latitude = %s, longitude = %s WHERE id = %s",
+                   (request.form['razao_social'], request.form['bandeira'], request.form['cnpj'], request.form['av_rua'], request.form['cidade'], request.form['uf'], request.form['grupo_id'],
+                    coordenada(request.form.get('latitude'), 90), coordenada(request.form.get('longitude'), 180), id))
         db.commit()
         cursor_dml.close()
         flash("Loja atualizada com sucesso!", "success")
         return redirect(url_for('gerenciamento'))
     cursor.execute("SELECT * FROM lojas WHERE id = %s", (id,))
     loja = cursor.fetchone()
-    cursor.execute("SELECT * FROM grupos ORDER BY nome")
+    cursor.execute("SELECT * FROM grupos WHERE removido_em IS NULL ORDER BY nome")
     grupos = cursor.fetchall()
     cursor.close()
     return render_template('edit_loja.html', loja=loja, grupos=grupos, title="Editar Loja")
@@ -463,27 +913,41 @@ def edit_loja(id):
 @app.route('/admin/lojas/importar', methods=['POST'])
 def importar_lojas():
     if 'user_type' not in session or session['user_type'] != 'master': return redirect(url_for('login'))
+    import pandas as pd
     grupo_id = request.form.get('grupo_id_import')
     file = request.files.get('planilha_lojas')
     if not all([grupo_id, file]):
         flash("É necessário selecionar um grupo e um ficheiro para importar.", "warning")
         return redirect(url_for('gerenciamento'))
+    db = get_db()
     try:
         df = pd.read_excel(file)
-        db = get_db()
         cursor = db.cursor()
-        df.columns = [col.strip().upper() for col in df.columns]
-        for index, row in df.iterrows():
-            if pd.isna(row['CNPJ']): continue
-            sql = """
-                INSERT INTO lojas (razao_social, cnpj, bandeira, av_rua, cidade, uf, grupo_id)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT(cnpj) DO UPDATE SET
-                    razao_social=excluded.razao_social, bandeira=excluded.bandeira,
-                    av_rua=excluded.av_rua, cidade=excluded.cidade, uf=excluded.uf,
-                    grupo_id=excluded.grupo_id;
-            """
-            cursor.execute(sql, (row.get('RAZAO_SOCIAL'), str(row.get('CNPJ')), row.get('BANDEIRA'), row.get('ENDERECO'), row.get('CIDADE'), row.get('UF'), grupo_id))
+        df.columns = [str(col).strip().upper() for col in df.columns]
+        df = df[df['CNPJ'].notna()].copy()
+        for coluna in ('RAZAO_SOCIAL', 'BANDEIRA', 'ENDERECO', 'CIDADE', 'UF', 'LATITUDE', 'LONGITUDE'):
+            if coluna not in df.columns:
+                df[coluna] = None
+        df['CNPJ'] = df['CNPJ'].astype(str)
+        # Coordenadas aceitam vírgula decimal; valores inválidos ou fora do intervalo ficam nulos.
+        for coluna, limite in (('LATITUDE', 90), ('LONGITUDE', 180)):
+            valores = pd.to_numeric(df[coluna].astype(str).str.replace(',', '.', regex=False), errors='coerce')
+            df[coluna] = valores.where(valores.abs() <= limite)
+        # Um único INSERT ... ON CONFLICT não pode tocar duas vezes a mesma loja: fica a última linha de cada CNPJ.
+        df = df.drop_duplicates(subset='CNPJ', keep='last')
+        df = df.astype(object).where(df.notna(), None)
+        valores = [(r['RAZAO_SOCIAL'], r['CNPJ'], r['BANDEIRA'], r['ENDERECO'], r['CIDADE'], r['UF'], grupo_id, r['LATITUDE'], r['LONGITUDE'])
+                   for r in df.to_dict('records')]
+        sql = """
+            INSERT INTO lojas (razao_social, cnpj, bandeira, av_rua, cidade, uf, grupo_id, latitude, longitude)
+            VALUES %s
+            ON CONFLICT(cnpj) DO UPDATE SET
+                razao_social=excluded.razao_social, bandeira=excluded.bandeira,
+                av_rua=excluded.av_rua, cidade=excluded.cidade, uf=excluded.uf,
+                grupo_id=excluded.grupo_id,
+                latitude=COALESCE(excluded.latitude, lojas.latitude), longitude=COALESCE(excluded.longitude, lojas.longitude);
+        """
+        execute_values(cursor, sql, valores, page_size=1000)
         db.commit()
         cursor.close()
         flash(f"Lojas importadas com sucesso para o grupo selecionado!", 'success')
@@ -497,12 +961,8 @@ def relatorios():
     if 'user_type' not in session or session['user_type'] != 'master': return redirect(url_for('login'))
     db = get_db()
     cursor = db.cursor(cursor_factory=DictCursor)
-    cursor.execute("SELECT * FROM grupos ORDER BY nome")
+    cursor.execute("SELECT * FROM grupos WHERE removido_em IS NULL ORDER BY nome")
     grupos = cursor.fetchall()
-    cursor.execute("SELECT id, nome_completo FROM usuarios WHERE tipo = 'promotora' ORDER BY nome_completo")
-    promotoras = cursor.fetchall()
-    cursor.execute("SELECT id, razao_social FROM lojas ORDER BY razao_social")
-    lojas = cursor.fetchall()
     if request.method == 'POST':
         active_tab = 'avancado'
     else:
@@ -510,18 +970,12 @@ def relatorios():
     filtros_diarios = {'grupo_id': request.args.get('filtro_grupo_id', ''), 'data': request.args.get('filtro_data', datetime.now().strftime('%Y-%m-%d'))}
     relatorios_diarios = []
     if filtros_diarios['grupo_id'] and filtros_diarios['data']:
-        query_diario = "SELECT r.id, r.data_hora, u.nome_completo, l.razao_social FROM relatorios r JOIN usuarios u ON r.usuario_id = u.id JOIN lojas l ON r.loja_id = l.id WHERE l.grupo_id = %s AND r.data = %s ORDER BY r.data_hora DESC"
-        cursor.execute(query_diario, (filtros_diarios['grupo_id'], filtros_diarios['data']))
-        reports = cursor.fetchall()
-        for report in reports:
-            cursor.execute("SELECT cr.label_campo, dr.valor FROM dados_relatorio dr JOIN campos_relatorio cr ON dr.campo_id = cr.id WHERE dr.relatorio_id = %s", (report['id'],))
-            dados = cursor.fetchall()
-            relatorios_diarios.append({'info': report, 'dados': dados})
+        relatorios_diarios = relatorios_do_dia(cursor, filtros_diarios['grupo_id'], filtros_diarios['data'])
     filtros_avancados = MultiDict(request.form) if request.method == 'POST' else MultiDict(request.args)
     campos_disponiveis = []
     grupo_id_avancado = filtros_avancados.get('grupo_id')
     if grupo_id_avancado:
-        cursor.execute("SELECT id, label_campo FROM campos_relatorio WHERE grupo_id = %s ORDER BY label_campo", (grupo_id_avancado,))
+        cursor.execute("SELECT id, label_campo FROM campos_relatorio WHERE grupo_id = %s AND removido_em IS NULL ORDER BY label_campo", (grupo_id_avancado,))
         campos_disponiveis = cursor.fetchall()
     resultados_avancados = []
     headers = []
@@ -545,8 +999,9 @@ def relatorios():
                 headers.append(f"{nome_coluna} (Média)")
         if colunas_select:
             query_base = f"SELECT u.nome_completo, l.razao_social, {', '.join(colunas_select)} FROM relatorios r JOIN usuarios u ON r.usuario_id = u.id JOIN lojas l ON r.loja_id = l.id JOIN dados_relatorio dr ON r.id = dr.relatorio_id"
-            where_clauses = ["l.grupo_id = %s", "r.data BETWEEN %s AND %s"]
-            params = [grupo_id_avancado, data_inicio, data_fim]
+            # Só os valores dos campos escolhidos: deixa o planejador ler dados_relatorio pelo índice de campo_id.
+            where_clauses = ["l.grupo_id = %s", "r.data BETWEEN %s AND %s", "dr.campo_id = ANY(%s)"]
+            params = [grupo_id_avancado, data_inicio, data_fim, [int(campo.split('_')[0]) for campo in campos_selecionados]]
             if promotora_id_avancado:
                 where_clauses.append("u.id = %s")
                 params.append(promotora_id_avancado)
@@ -557,7 +1012,7 @@ def relatorios():
             cursor.execute(query_dinamica, tuple(params))
             resultados_avancados = cursor.fetchall()
     filtros_checkins = {'promotora_id': request.args.get('filtro_checkin_promotora_id', ''), 'loja_id': request.args.get('filtro_checkin_loja_id', ''), 'data_inicio': request.args.get('filtro_checkin_data_inicio', (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')), 'data_fim': request.args.get('filtro_checkin_data_fim', datetime.now().strftime('%Y-%m-%d'))}
-    query_checkins_base = "SELECT c.data_hora, c.tipo, c.latitude, c.longitude, c.imagem_path, u.nome_completo, l.razao_social FROM checkins c JOIN usuarios u ON c.usuario_id = u.id JOIN lojas l ON c.loja_id = l.id WHERE c.data_hora::date BETWEEN %s AND %s"
+    query_checkins_base = "SELECT c.data_hora, c.tipo, c.latitude, c.longitude, c.imagem_path, u.nome_completo, l.razao_social, l.latitude AS loja_latitude, l.longitude AS loja_longitude FROM checkins c JOIN usuarios u ON c.usuario_id = u.id JOIN lojas l ON c.loja_id = l.id WHERE c.data_hora >= %s::date AND c.data_hora < %s::date + 1"
     params_checkins = [filtros_checkins['data_inicio'], filtros_checkins['data_fim']]
     if filtros_checkins['promotora_id']:
         query_checkins_base += " AND u.id = %s"
@@ -567,38 +1022,50 @@ def relatorios():
         params_checkins.append(filtros_checkins['loja_id'])
     query_checkins_base += " ORDER BY c.data_hora DESC"
     cursor.execute(query_checkins_base, tuple(params_checkins))
-    historico_checkins = cursor.fetchall()
+    historico_checkins = [dict(c) for c in cursor.fetchall()]
+    if historico_checkins:
+        distancias = haversine_m([c['latitude'] for c in historico_checkins], [c['longitude'] for c in historico_checkins],
+                                 [c['loja_latitude'] for c in historico_checkins], [c['loja_longitude'] for c in historico_checkins])
+        for checkin_linha, distancia in zip(historico_checkins, distancias.tolist()):
+            checkin_linha['distancia_m'] = None if math.isnan(distancia) else distancia
+            checkin_linha['fora_do_raio'] = checkin_linha['distancia_m'] is not None and distancia > RAIO_CHECKIN_METROS
+    # Os filtros de promotora e loja usam a busca em /api/busca; só as opções já escolhidas são renderizadas.
+    promotora_ids = [int(i) for i in (filtros_avancados.get('promotora_id'), filtros_checkins['promotora_id']) if i and str(i).isdigit()]
+    loja_ids = [int(i) for i in (filtros_avancados.get('loja_id'), filtros_checkins['loja_id']) if i and str(i).isdigit()]
+    cursor.execute("SELECT id, nome_completo FROM usuarios WHERE id = ANY(%s) ORDER BY nome_completo", (promotora_ids,))
+    promotoras = cursor.fetchall()
+    cursor.execute("SELECT id, razao_social FROM lojas WHERE id = ANY(%s) ORDER BY razao_social", (loja_ids,))
+    lojas = cursor.fetchall()
     cursor.close()
     return render_template('relatorios.html', title="Relatórios", grupos=grupos, promotoras=promotoras, lojas=lojas, relatorios_diarios=relatorios_diarios, resultados_avancados=resultados_avancados, headers=headers, filtros_diarios=filtros_diarios, filtros_avancados=filtros_avancados, campos_disponiveis=campos_disponiveis, historico_checkins=historico_checkins, filtros_checkins=filtros_checkins, active_tab=active_tab, s3_location=S3_LOCATION)
 
 @app.route('/admin/relatorios/exportar/diario')
 def exportar_relatorio_diario():
     if 'user_type' not in session or session['user_type'] != 'master': return redirect(url_for('login'))
+    from openpyxl import Workbook
     db = get_db()
     grupo_id = request.args.get('filtro_grupo_id')
     data = request.args.get('filtro_data')
     if not all([grupo_id, data]):
         flash("Filtros de grupo e data são necessários para exportar.", "warning")
         return redirect(url_for('relatorios'))
-    query = """
-        SELECT r.data_hora, u.nome_completo as "Promotora", l.razao_social as "Loja", cr.label_campo, dr.valor
-        FROM relatorios r JOIN usuarios u ON r.usuario_id = u.id JOIN lojas l ON r.loja_id = l.id
-        JOIN dados_relatorio dr ON r.id = dr.relatorio_id JOIN campos_relatorio cr ON dr.campo_id = cr.id
-        WHERE l.grupo_id = %s AND r.data = %s ORDER BY r.data_hora, u.nome_completo
-    """
-    df_long = pd.read_sql_query(query, db, params=(grupo_id, data))
-    if df_long.empty:
+    labels, linhas = relatorio_diario(db, grupo_id, data)
+    primeira = next(linhas, None)
+    if primeira is None:
         flash("Nenhum dado encontrado para exportar com os filtros selecionados.", "info")
         return redirect(url_for('relatorios', tab='diario', filtro_grupo_id=grupo_id, filtro_data=data))
-    df_wide = df_long.pivot_table(index=['data_hora', 'Promotora', 'Loja'], columns='label_campo', values='valor', aggfunc='first').reset_index()
+    wb = Workbook(write_only=True)
+    folha_write_only(wb, 'Relatorio_Diario', ['data_hora', 'Promotora', 'Loja'] + labels, chain([primeira], linhas),
+                     formatos={0: 'YYYY-MM-DD HH:MM:SS'})
     output = BytesIO()
-    df_wide.to_excel(output, index=False, sheet_name='Relatorio_Diario')
+    wb.save(output)
     output.seek(0)
     return send_file(output, as_attachment=True, download_name=f'relatorio_diario_{data}.xlsx')
 
 @app.route('/admin/relatorios/exportar/avancado')
 def exportar_relatorio_avancado():
     if 'user_type' not in session or session['user_type'] != 'master': return redirect(url_for('login'))
+    import pandas as pd
     db = get_db()
     filtros = MultiDict(request.args)
     campos_selecionados = filtros.getlist('campos')
@@ -611,7 +1078,7 @@ def exportar_relatorio_avancado():
     promotora_id_avancado = filtros.get('promotora_id')
     loja_id_avancado = filtros.get('loja_id')
     cursor = db.cursor(cursor_factory=DictCursor)
-    cursor.execute("SELECT id, label_campo FROM campos_relatorio WHERE grupo_id = %s ORDER BY label_campo", (grupo_id_avancado,))
+    cursor.execute("SELECT id, label_campo FROM campos_relatorio WHERE grupo_id = %s AND removido_em IS NULL ORDER BY label_campo", (grupo_id_avancado,))
     campos_disponiveis = cursor.fetchall()
     campos_info = {str(c['id']): c['label_campo'] for c in campos_disponiveis}
     colunas_select = []
@@ -626,8 +1093,8 @@ def exportar_relatorio_avancado():
         flash("Erro ao processar campos para exportação.", "danger")
         return redirect(url_for('relatorios', **request.args))
     query_base = f'SELECT u.nome_completo as "Promotora", l.razao_social as "Loja", {", ".join(colunas_select)} FROM relatorios r JOIN usuarios u ON r.usuario_id = u.id JOIN lojas l ON r.loja_id = l.id JOIN dados_relatorio dr ON r.id = dr.relatorio_id'
-    where_clauses = ["l.grupo_id = %s", "r.data BETWEEN %s AND %s"]
-    params = [grupo_id_avancado, data_inicio, data_fim]
+    where_clauses = ["l.grupo_id = %s", "r.data BETWEEN %s AND %s", "dr.campo_id = ANY(%s)"]
+    params = [grupo_id_avancado, data_inicio, data_fim, [int(campo.split('_')[0]) for campo in campos_selecionados]]
     if promotora_id_avancado:
         where_clauses.append("u.id = %s")
         params.append(promotora_id_avancado)
@@ -647,9 +1114,10 @@ def exportar_relatorio_avancado():
 @app.route('/admin/relatorios/exportar/checkin')
 def exportar_historico_checkin():
     if 'user_type' not in session or session['user_type'] != 'master': return redirect(url_for('login'))
+    import pandas as pd
     db = get_db()
     filtros = {'promotora_id': request.args.get('filtro_checkin_promotora_id', ''), 'loja_id': request.args.get('filtro_checkin_loja_id', ''), 'data_inicio': request.args.get('filtro_checkin_data_inicio'), 'data_fim': request.args.get('filtro_checkin_data_fim')}
-    query_base = "SELECT c.data_hora, u.nome_completo as \"Promotora\", l.razao_social as \"Loja\", c.tipo, c.latitude, c.longitude FROM checkins c JOIN usuarios u ON c.usuario_id = u.id JOIN lojas l ON c.loja_id = l.id WHERE c.data_hora::date BETWEEN %s AND %s"
+    query_base = "SELECT c.data_hora, u.nome_completo as \"Promotora\", l.razao_social as \"Loja\", c.tipo, c.latitude, c.longitude, l.latitude AS loja_latitude, l.longitude AS loja_longitude FROM checkins c JOIN usuarios u ON c.usuario_id = u.id JOIN lojas l ON c.loja_id = l.id WHERE c.data_hora >= %s::date AND c.data_hora < %s::date + 1"
     params = [filtros['data_inicio'], filtros['data_fim']]
     if filtros['promotora_id']:
         query_base += " AND u.id = %s"
@@ -662,6 +1130,10 @@ def exportar_historico_checkin():
     if df.empty:
         flash("Nenhum dado encontrado para exportar com os filtros selecionados.", "info")
         return redirect(url_for('relatorios', **request.args))
+    distancias = haversine_m(df['latitude'], df['longitude'], df['loja_latitude'], df['loja_longitude'])
+    df['Distância da Loja (m)'] = distancias.round(0)
+    df['Fora do Raio'] = distancias > RAIO_CHECKIN_METROS
+    df = df.drop(columns=['loja_latitude', 'loja_longitude'])
     output = BytesIO()
     df.to_excel(output, index=False, sheet_name='Historico_Checkins')
     output.seek(0)
@@ -674,7 +1146,7 @@ def api_campos_grupo(grupo_id):
     cursor.execute("""
         SELECT id, label_campo, tipo, tamanho
         FROM campos_relatorio
-        WHERE grupo_id = %s
+        WHERE grupo_id = %s AND removido_em IS NULL
         ORDER BY id
     """, (grupo_id,))
     campos = cursor.fetchall()
@@ -699,10 +1171,11 @@ def performance():
 @app.route('/admin/lojas/exportar')
 def exportar_lojas():
     if 'user_type' not in session or session['user_type'] != 'master': return redirect(url_for('login'))
+    import pandas as pd
     db = get_db()
-    query = 'SELECT l.razao_social, l.cnpj, l.bandeira, l.av_rua, l.cidade, l.uf, g.nome as grupo FROM lojas l LEFT JOIN grupos g ON l.grupo_id = g.id'
+    query = 'SELECT l.razao_social, l.cnpj, l.bandeira, l.av_rua, l.cidade, l.uf, l.latitude, l.longitude, g.nome as grupo FROM lojas l LEFT JOIN grupos g ON l.grupo_id = g.id AND g.removido_em IS NULL'
     df = pd.read_sql_query(query, db)
-    df.rename(columns={'razao_social': 'RAZAO_SOCIAL','cnpj': 'CNPJ','bandeira': 'BANDEIRA','av_rua': 'ENDERECO','cidade': 'CIDADE','uf': 'UF', 'grupo': 'GRUPO'}, inplace=True)
+    df.rename(columns={'razao_social': 'RAZAO_SOCIAL','cnpj': 'CNPJ','bandeira': 'BANDEIRA','av_rua': 'ENDERECO','cidade': 'CIDADE','uf': 'UF', 'latitude': 'LATITUDE', 'longitude': 'LONGITUDE', 'grupo': 'GRUPO'}, inplace=True)
     output = BytesIO()
     df.to_excel(output, index=False, sheet_name='Lojas')
     output.seek(0)
@@ -711,8 +1184,9 @@ def exportar_lojas():
 @app.route('/admin/promotoras/exportar')
 def exportar_promotoras():
     if 'user_type' not in session or session['user_type'] != 'master': return redirect(url_for('login'))
+    import pandas as pd
     db = get_db()
-    query = "SELECT u.nome_completo, u.cpf, u.telefone, u.cidade, u.uf, l.cnpj as cnpj_loja, g.nome as grupo FROM usuarios u JOIN promotora_lojas pl ON u.id = pl.usuario_id JOIN lojas l ON pl.loja_id = l.id LEFT JOIN grupos g ON l.grupo_id = g.id WHERE u.tipo = 'promotora'"
+    query = "SELECT u.nome_completo, u.cpf, u.telefone, u.cidade, u.uf, l.cnpj as cnpj_loja, g.nome as grupo FROM usuarios u JOIN promotora_lojas pl ON u.id = pl.usuario_id JOIN lojas l ON pl.loja_id = l.id LEFT JOIN grupos g ON l.grupo_id = g.id AND g.removido_em IS NULL WHERE u.tipo = 'promotora'"
     df = pd.read_sql_query(query, db)
     df.rename(columns={'nome_completo': 'NOME', 'cpf': 'CPF', 'telefone': 'TELEFONE','cidade': 'CIDADE', 'uf': 'UF', 'cnpj_loja': 'CNPJ_LOJA', 'grupo': 'GRUPO'}, inplace=True)
     output = BytesIO()
@@ -724,6 +1198,7 @@ def exportar_promotoras():
 def importar_promotoras():
     if 'user_type' not in session or session['user_type'] != 'master':
         return redirect(url_for('login'))
+    import pandas as pd
     file = request.files.get('planilha_promotoras')
     if not file or file.filename == '':
         flash('Nenhum ficheiro selecionado', 'danger')
@@ -752,20 +1227,19 @@ def importar_promotoras():
             sql_upsert_user = "INSERT INTO usuarios (usuario, senha_hash, tipo, nome_completo, cpf, telefone, cidade, uf) VALUES (%s, %s, 'promotora', %s, %s, %s, %s, %s) ON CONFLICT(telefone) DO UPDATE SET nome_completo=excluded.nome_completo, cpf=excluded.cpf, cidade=excluded.cidade, uf=excluded.uf RETURNING id;"
             cursor.execute(sql_upsert_user, (telefone, senha_hash, nome_completo, cpf, telefone, cidade, uf))
             promotora_id = cursor.fetchone()[0]
-            cursor.execute("DELETE FROM promotora_lojas WHERE usuario_id = %s", (promotora_id,))
+            lojas_da_promotora = []
             for _, sub_row in group.iterrows():
                 grupo_nome = sub_row.get('GRUPO')
                 cnpj_loja = sub_row.get('CNPJ_LOJA')
                 if pd.notna(grupo_nome) and str(grupo_nome).strip() != '':
-                    cursor.execute("SELECT id FROM lojas WHERE grupo_id = (SELECT id FROM grupos WHERE nome = %s)", (str(grupo_nome).strip(),))
-                    lojas_do_grupo = cursor.fetchall()
-                    for loja in lojas_do_grupo:
-                        cursor.execute("INSERT INTO promotora_lojas (usuario_id, loja_id) VALUES (%s, %s) ON CONFLICT DO NOTHING", (promotora_id, loja[0]))
+                    cursor.execute("SELECT id FROM lojas WHERE grupo_id = (SELECT id FROM grupos WHERE nome = %s AND removido_em IS NULL)", (str(grupo_nome).strip(),))
+                    lojas_da_promotora.extend(loja[0] for loja in cursor.fetchall())
                 elif pd.notna(cnpj_loja):
                     cursor.execute("SELECT id FROM lojas WHERE cnpj = %s", (str(cnpj_loja),))
                     loja = cursor.fetchone()
                     if loja:
-                        cursor.execute("INSERT INTO promotora_lojas (usuario_id, loja_id) VALUES (%s, %s) ON CONFLICT DO NOTHING", (promotora_id, loja[0]))
+                        lojas_da_promotora.append(loja[0])
+            atualizar_lojas_promotora(cursor, promotora_id, lojas_da_promotora)
         db.commit()
         cursor.close()
         flash('Planilha de promotoras importada com sucesso!', 'success')
@@ -820,24 +1294,20 @@ def edit_promotora(id):
         uf = request.form.get('uf')
         loja_ids_selecionadas = request.form.getlist('loja_ids')
         cursor_dml.execute("UPDATE usuarios SET nome_completo=%s, cpf=%s, telefone=%s, cidade=%s, uf=%s WHERE id=%s", (nome_completo, cpf, telefone, cidade, uf, id))
-        cursor_dml.execute("DELETE FROM promotora_lojas WHERE usuario_id = %s", (id,))
-        for loja_id in loja_ids_selecionadas:
-            cursor_dml.execute("INSERT INTO promotora_lojas (usuario_id, loja_id) VALUES (%s, %s)", (id, loja_id))
+        atualizar_lojas_promotora(cursor_dml, id, loja_ids_selecionadas)
         db.commit()
         cursor_dml.close()
         flash("Promotora atualizada com sucesso!", "success")
         return redirect(url_for('gerenciamento'))
     cursor.execute("SELECT * FROM usuarios WHERE id = %s", (id,))
     promotora = cursor.fetchone()
-    cursor.execute("SELECT * FROM lojas ORDER BY razao_social")
-    lojas = cursor.fetchall()
-    cursor.execute("SELECT * FROM grupos ORDER BY nome")
+    # Só as lojas já associadas são renderizadas; as restantes são pesquisadas em /api/admin/lojas.
+    cursor.execute("SELECT l.id, l.razao_social, l.grupo_id, l.uf FROM lojas l JOIN promotora_lojas pl ON l.id = pl.loja_id WHERE pl.usuario_id = %s ORDER BY l.razao_social", (id,))
+    lojas_associadas = cursor.fetchall()
+    cursor.execute("SELECT * FROM grupos WHERE removido_em IS NULL ORDER BY nome")
     grupos = cursor.fetchall()
-    cursor.execute("SELECT loja_id FROM promotora_lojas WHERE usuario_id = %s", (id,))
-    lojas_associadas_raw = cursor.fetchall()
-    lojas_associadas_ids = [item['loja_id'] for item in lojas_associadas_raw]
     cursor.close()
-    return render_template('edit_promotora.html', promotora=promotora, lojas=lojas, lojas_associadas_ids=lojas_associadas_ids, grupos=grupos)
+    return render_template('edit_promotora.html', promotora=promotora, lojas_associadas=lojas_associadas, grupos=grupos)
 
 @app.route('/admin/promotora/toggle/<int:id>', methods=['POST'])
 def toggle_active_promotora(id):
@@ -849,30 +1319,684 @@ def toggle_active_promotora(id):
     if promotora:
         novo_status = 0 if promotora['ativo'] else 1
         cursor_dml = db.cursor()
-        cursor_dml.execute("UPDATE usuarios SET ativo = %s WHERE id = %s", (novo_status, id))
+        cursor_dml.execute("UPDATE usuarios SET ativo = %s, inativo_desde = CASE WHEN %s = 0 THEN NOW() END WHERE id = %s", (novo_status, novo_status, id))
         db.commit()
         cursor_dml.close()
         flash("Status da promotora atualizado.", "success")
     cursor.close()
     return redirect(url_for('gerenciamento'))
 
-@app.route("/relatorios_avancados/<int:grupo_id>")
-def relatorios_avancados(grupo_id):
+# --- API DE GERENCIAMENTO (filtros, ordenação e paginação por keyset) ---
+PAGINA_PADRAO = 50
+PAGINA_MAXIMA = 200
+
+# Colunas ordenáveis: nome exposto na API -> expressão SQL sem NULLs (coberta por um índice (expressão, id)).
+ORDENACAO_LOJAS = {
+    'razao_social': "l.razao_social",
+    'cnpj': "COALESCE(l.cnpj, '')",
+    'cidade': "COALESCE(l.cidade, '')",
+    'uf': "COALESCE(l.uf, '')",
+}
+ORDENACAO_PROMOTORAS = {
+    'nome_completo': "COALESCE(u.nome_completo, '')",
+    'telefone': "COALESCE(u.telefone, '')",
+    'cidade': "COALESCE(u.cidade, '')",
+}
+
+def consulta_paginada(cursor, colunas_sql, from_sql, where, params, ordenacoes, ordem_padrao, coluna_id):
+    """
+    Executa uma consulta paginada por keyset a partir dos argumentos 'ordem', 'direcao', 'limite',
+    'apos_valor' e 'apos_id' do pedido. Devolve (linhas, próximo cursor ou None).
+    """
+    ordem = request.args.get('ordem', ordem_padrao)
+    if ordem not in ordenacoes:
+        ordem = ordem_padrao
+    expressao = ordenacoes[ordem]
+    direcao = 'DESC' if request.args.get('direcao', 'asc').lower() == 'desc' else 'ASC'
+    limite = request.args.get('limite', PAGINA_PADRAO, type=int)
+    limite = min(max(limite, 1), PAGINA_MAXIMA)
+    apos_valor = request.args.get('apos_valor')
+    apos_id = request.args.get('apos_id', type=int)
+    where = list(where)
+    params = list(params)
+    if apos_valor is not None and apos_id is not None:
+        operador = '<' if direcao == 'DESC' else '>'
+        where.append(f"({expressao}, {coluna_id}) {operador} (%s, %s)")
+        params.extend([apos_valor, apos_id])
+    query = f"SELECT {colunas_sql}, {expressao} AS _ordem FROM {from_sql}"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    # Pede uma linha a mais para saber se existe próxima página sem um COUNT(*).
+    query += f" ORDER BY {expressao} {direcao}, {coluna_id} {direcao} LIMIT %s"
+    params.append(limite + 1)
+    cursor.execute(query, tuple(params))
+    linhas = cursor.fetchall()
+    proximo = None
+    if len(linhas) > limite:
+        linhas = linhas[:limite]
+        proximo = {'apos_valor': linhas[-1]['_ordem'], 'apos_id': linhas[-1]['id']}
+    return linhas, proximo
+
+def filtros_lojas():
+    """Filtros de grupo e UF comuns à listagem e à busca de lojas."""
+    where, params = [], []
+    grupo_id = request.args.get('grupo_id', '')
+    if grupo_id == 'sem':
+        where.append("l.grupo_id IS NULL")
+    elif grupo_id.isdigit():
+        where.append("l.grupo_id = %s")
+        params.append(int(grupo_id))
+    uf = request.args.get('uf', '').strip().upper()
+    if uf:
+        where.append("UPPER(l.uf) = %s")
+        params.append(uf)
+    return where, params
+
+def filtros_promotoras():
+    """Filtros comuns à listagem e à busca de promotoras."""
+    where, params = ["u.tipo = 'promotora'"], []
+    ativo = request.args.get('ativo', '')
+    if ativo in ('0', '1'):
+        where.append("u.ativo = %s")
+        params.append(int(ativo))
+    return where, params
+
+@app.route('/api/admin/lojas')
+def api_lojas():
+    if 'user_type' not in session or session['user_type'] != 'master': return jsonify({'erro': 'Não autorizado'}), 403
+    db = get_db()
+    cursor = db.cursor(cursor_factory=DictCursor)
+    where, params = filtros_lojas()
+    termo = request.args.get('q', '').strip()
+    if termo:
+        condicao, params_condicao = condicao_busca_lojas(termo)
+        where.append(condicao)
+        params.extend(params_condicao)
+    colunas_sql = "l.id, l.razao_social, l.bandeira, l.cnpj, l.cidade, l.uf, l.grupo_id, g.nome AS grupo_nome"
+    linhas, proximo = consulta_paginada(cursor, colunas_sql, "lojas l LEFT JOIN grupos g ON l.grupo_id = g.id AND g.removido_em IS NULL", where, params, ORDENACAO_LOJAS, 'razao_social', 'l.id')
+    cursor.close()
+    lojas = []
+    for linha in linhas:
+        loja = {k: linha[k] for k in ('id', 'razao_social', 'bandeira', 'cnpj', 'cidade', 'uf', 'grupo_id', 'grupo_nome')}
+        loja['url_editar'] = url_for('edit_loja', id=linha['id'])
+        lojas.append(loja)
+    return jsonify({'itens': lojas, 'proximo': proximo})
+
+@app.route('/api/admin/promotoras')
+def api_promotoras():
+    if 'user_type' not in session or session['user_type'] != 'master': return jsonify({'erro': 'Não autorizado'}), 403
+    db = get_db()
+    cursor = db.cursor(cursor_factory=DictCursor)
+    where, params = filtros_promotoras()
+    termo = request.args.get('q', '').strip()
+    if termo:
+        condicao, params_condicao = condicao_busca_promotoras(termo)
+        where.append(condicao)
+        params.extend(params_condicao)
+    # A contagem de lojas é feita só para as linhas da página, pelo índice único (usuario_id, loja_id).
+    colunas_sql = "u.id, u.nome_completo, u.telefone, u.cidade, u.uf, u.ativo, (SELECT COUNT(*) FROM promotora_lojas pl WHERE pl.usuario_id = u.id) AS total_lojas"
+    linhas, proximo = consulta_paginada(cursor, colunas_sql, "usuarios u", where, params, ORDENACAO_PROMOTORAS, 'nome_completo', 'u.id')
+    cursor.close()
+    promotoras = []
+    for linha in linhas:
+        promotora = {k: linha[k] for k in ('id', 'nome_completo', 'telefone', 'cidade', 'uf', 'ativo', 'total_lojas')}
+        promotora['url_editar'] = url_for('edit_promotora', id=linha['id'])
+        promotora['url_toggle'] = url_for('toggle_active_promotora', id=linha['id'])
+        promotoras.append(promotora)
+    return jsonify({'itens': promotoras, 'proximo': proximo})
+
+# --- GEOLOCALIZAÇÃO (coordenadas das lojas e validação de check-ins) ---
+RAIO_TERRA_M = 6371000.0
+# Distância máxima (em metros) entre o check-in e a loja antes de o registo ser marcado como fora do raio.
+RAIO_CHECKIN_METROS = float(os.environ.get('RAIO_CHECKIN_METROS', '300'))
+# Tamanho da célula da grelha; tem de coincidir com a coluna gerada lojas.geo_celula em init_db().
+GEO_CELULA_GRAUS = 0.05
+
+DISTANCIA_LOJA_SQL = """
+    2 * 6371000 * asin(sqrt(
+        power(sin(radians(l.latitude - %(latitude)s) / 2), 2) +
+        cos(radians(%(latitude)s)) * cos(radians(l.latitude)) * power(sin(radians(l.longitude - %(longitude)s) / 2), 2)
+    ))
+"""
+
+def coordenada(valor, limite):
+    """Converte o valor de um formulário numa coordenada válida (aceita vírgula decimal) ou None."""
+    try:
+        numero = float(str(valor).replace(',', '.'))
+    except (TypeError, ValueError):
+        return None
+    return numero if abs(numero) <= limite else None
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """
+    Distância em metros entre pares de pontos, calculada de forma vetorizada com NumPy.
+    Aceita escalares, listas, arrays ou Series; pontos sem coordenadas (None/NaN) resultam em NaN.
+    """
+    import numpy as np
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=float)) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * RAIO_TERRA_M * np.arcsin(np.sqrt(a))
+
+def celulas_vizinhas(latitude, longitude):
+    """Células da grelha (a do ponto e as 8 à volta), com a mesma fórmula de lojas.geo_celula."""
+    linha = math.floor((latitude + 90) / GEO_CELULA_GRAUS)
+    coluna = math.floor((longitude + 180) / GEO_CELULA_GRAUS)
+    return [(linha + dl) * 10000 + (coluna + dc) for dl in (-1, 0, 1) for dc in (-1, 0, 1)]
+
+def loja_mais_proxima(cursor, usuario_id, latitude, longitude):
+    """
+    Loja associada à promotora mais próxima do ponto, com a distância em metros.
+    Procura primeiro nas células vizinhas (índice idx_lojas_geo_celula); se o candidato estiver
+    a mais de uma célula de distância, pode haver outra mais perto, e consulta todas as lojas associadas.
+    """
+    params = {'usuario_id': usuario_id, 'latitude': latitude, 'longitude': longitude, 'celulas': celulas_vizinhas(latitude, longitude)}
+    base = f"""
+        SELECT l.id, l.razao_social, {DISTANCIA_LOJA_SQL} AS distancia_m
+        FROM lojas l JOIN promotora_lojas pl ON l.id = pl.loja_id
+        WHERE pl.usuario_id = %(usuario_id)s AND l.latitude IS NOT NULL AND l.longitude IS NOT NULL
+    """
+    cursor.execute(base + " AND l.geo_celula = ANY(%(celulas)s) ORDER BY distancia_m LIMIT 1", params)
+    loja = cursor.fetchone()
+    # Largura mínima de uma célula no terreno (a de longitude encolhe com a latitude).
+    raio_garantido = GEO_CELULA_GRAUS * math.pi / 180 * RAIO_TERRA_M * math.cos(math.radians(min(abs(latitude), 89.0)))
+    if loja and loja['distancia_m'] <= raio_garantido:
+        return loja
+    cursor.execute(base + " ORDER BY distancia_m LIMIT 1", params)
+    return cursor.fetchone()
+
+@app.route('/api/checkin/loja-proxima')
+def api_loja_proxima():
+    if 'user_type' not in session or session['user_type'] != 'promotora': return jsonify({'erro': 'Não autorizado'}), 403
+    latitude = coordenada(request.args.get('latitude'), 90)
+    longitude = coordenada(request.args.get('longitude'), 180)
+    if latitude is None or longitude is None:
+        return jsonify({'loja': None})
+    db = get_db()
+    cursor = db.cursor(cursor_factory=DictCursor)
+    loja = loja_mais_proxima(cursor, session['user_id'], latitude, longitude)
+    cursor.close()
+    if not loja:
+        return jsonify({'loja': None})
+    return jsonify({'loja': {'id': loja['id'], 'razao_social': loja['razao_social'], 'distancia_m': round(loja['distancia_m']),
+                             'dentro_do_raio': loja['distancia_m'] <= RAIO_CHECKIN_METROS}})
+
+# --- HORAS EM LOJA (pareamento de check-in/checkout em visitas) ---
+# 'sql' usa funções de janela no Postgres; 'pandas' lê os eventos e faz o pareamento vetorizado em memória.
+MOTOR_HORAS = os.environ.get('MOTOR_HORAS', 'sql')
+# Número máximo de dias calculados por consulta/commit ao preencher a cache.
+HORAS_DIAS_POR_LOTE = 31
+
+# Regras do pareamento, por promotora, loja e dia (as visitas não atravessam a meia-noite):
+#  - envios repetidos do mesmo tipo em sequência contam uma vez (fica o primeiro);
+#  - cada check-in é pareado com o checkout seguinte; sem checkout, conta como visita sem saída e 0 horas;
+#  - um checkout no início do dia, sem check-in antes, conta como saída sem entrada.
+HORAS_SQL = """
+    WITH eventos AS (
+        SELECT id, usuario_id, loja_id, data_hora::date AS dia, tipo, data_hora,
+               LAG(tipo) OVER (PARTITION BY usuario_id, loja_id, data_hora::date ORDER BY data_hora, id) AS tipo_anterior
+        FROM checkins
+        WHERE data_hora >= %(inicio)s AND data_hora < %(fim)s AND data_hora::date = ANY(%(dias)s) {filtros}
+    ), unicos AS (
+        SELECT dia, usuario_id, loja_id, tipo, data_hora,
+               LAG(tipo) OVER w AS tipo_anterior,
+               LEAD(tipo) OVER w AS tipo_seguinte,
+               LEAD(data_hora) OVER w AS hora_seguinte
+        FROM eventos
+        WHERE tipo_anterior IS DISTINCT FROM tipo
+        WINDOW w AS (PARTITION BY usuario_id, loja_id, dia ORDER BY data_hora, id)
+    )
+    SELECT dia, usuario_id, loja_id,
+           COUNT(*) FILTER (WHERE tipo = 'checkin') AS visitas,
+           COUNT(*) FILTER (WHERE tipo = 'checkin' AND tipo_seguinte IS NULL) AS visitas_sem_saida,
+           COUNT(*) FILTER (WHERE tipo = 'checkout' AND tipo_anterior IS NULL) AS saidas_sem_entrada,
+           COALESCE(SUM(EXTRACT(EPOCH FROM hora_seguinte - data_hora)) FILTER (WHERE tipo = 'checkin' AND tipo_seguinte = 'checkout'), 0)::double precision / 3600 AS horas
+    FROM unicos
+    GROUP BY dia, usuario_id, loja_id
+"""
+COLUNAS_HORAS = ('dia', 'usuario_id', 'loja_id', 'visitas', 'visitas_sem_saida', 'saidas_sem_entrada', 'horas')
+
+def parear_checkins_df(df):
+    """
+    Versão vetorizada (pandas/NumPy) de HORAS_SQL, com as mesmas regras.
+    Recebe um DataFrame com id, usuario_id, loja_id, tipo e data_hora; devolve um por dia, promotora e loja.
+    """
+    import pandas as pd
+    if df.empty:
+        return pd.DataFrame(columns=COLUNAS_HORAS)
+    df = df.sort_values(['usuario_id', 'loja_id', 'data_hora', 'id']).copy()
+    df['dia'] = pd.to_datetime(df['data_hora']).dt.date
+    chave = ['usuario_id', 'loja_id', 'dia']
+    tipo_anterior = df.groupby(chave)['tipo'].shift()
+    df = df[tipo_anterior.ne(df['tipo'])].copy()
+    grupos = df.groupby(chave)
+    tipo_seguinte = grupos['tipo'].shift(-1)
+    hora_seguinte = grupos['data_hora'].shift(-1)
+    entrada = df['tipo'].eq('checkin')
+    pareada = entrada & tipo_seguinte.eq('checkout')
+    df['visitas'] = entrada.astype(int)
+    df['visitas_sem_saida'] = (entrada & tipo_seguinte.isna()).astype(int)
+    df['saidas_sem_entrada'] = (df['tipo'].eq('checkout') & grupos.cumcount().eq(0)).astype(int)
+    df['horas'] = ((hora_seguinte - df['data_hora']).dt.total_seconds() / 3600.0).where(pareada, 0.0)
+    resultado = df.groupby(chave, as_index=False)[['visitas', 'visitas_sem_saida', 'saidas_sem_entrada', 'horas']].sum()
+    return resultado[list(COLUNAS_HORAS)]
+
+def calcular_horas(cursor, dias, usuario_id=None, loja_id=None):
+    """Calcula as horas dos dias indicados diretamente a partir de checkins; devolve tuplos na ordem de COLUNAS_HORAS."""
+    filtros, params = "", {'inicio': min(dias), 'fim': max(dias) + timedelta(days=1), 'dias': list(dias)}
+    if usuario_id:
+        filtros += " AND usuario_id = %(usuario_id)s"
+        params['usuario_id'] = usuario_id
+    if loja_id:
+        filtros += " AND loja_id = %(loja_id)s"
+        params['loja_id'] = loja_id
+    if MOTOR_HORAS == 'pandas':
+        import pandas as pd
+        cursor.execute("SELECT id, usuario_id, loja_id, tipo, data_hora FROM checkins "
+                       "WHERE data_hora >= %(inicio)s AND data_hora < %(fim)s AND data_hora::date = ANY(%(dias)s)" + filtros, params)
+        eventos = pd.DataFrame(cursor.fetchall(), columns=['id', 'usuario_id', 'loja_id', 'tipo', 'data_hora'])
+        resultado = parear_checkins_df(eventos)
+        return [(r.dia, int(r.usuario_id), int(r.loja_id), int(r.visitas), int(r.visitas_sem_saida), int(r.saidas_sem_entrada), float(r.horas))
+                for r in resultado.itertuples(index=False)]
+    cursor.execute(HORAS_SQL.format(filtros=filtros), params)
+    return [tuple(linha) for linha in cursor.fetchall()]
+
+def garantir_horas_em_cache(db, data_inicio, data_fim):
+    """
+    Preenche horas_loja_dia para os dias fechados (anteriores a hoje) do intervalo que ainda não foram calculados.
+    Um dia fechado não recebe novos check-ins, por isso o resultado guardado não precisa de ser invalidado.
+    """
+    fim_fechado = min(data_fim, date.today() - timedelta(days=1))
+    if data_inicio > fim_fechado:
+        return
+    cursor = db.cursor()
+    cursor.execute("""
+        SELECT d::date FROM generate_series(%s::date, %s::date, INTERVAL '1 day') d
+        WHERE NOT EXISTS (SELECT 1 FROM horas_dias_calculados h WHERE h.dia = d::date) ORDER BY 1
+    """, (data_inicio, fim_fechado))
+    faltam = [linha[0] for linha in cursor.fetchall()]
+    for i in range(0, len(faltam), HORAS_DIAS_POR_LOTE):
+        lote = faltam[i:i + HORAS_DIAS_POR_LOTE]
+        linhas = calcular_horas(cursor, lote)
+        execute_values(cursor, """
+            INSERT INTO horas_loja_dia (dia, usuario_id, loja_id, visitas, visitas_sem_saida, saidas_sem_entrada, horas)
+            VALUES %s ON CONFLICT (dia, usuario_id, loja_id) DO NOTHING
+        """, linhas)
+        execute_values(cursor, "INSERT INTO horas_dias_calculados (dia) VALUES %s ON CONFLICT (dia) DO NOTHING", [(dia,) for dia in lote])
+        db.commit()
+    cursor.close()
+
+def horas_trabalhadas(db, data_inicio, data_fim, usuario_id=None, loja_id=None):
+    """
+    Horas por dia, promotora e loja no intervalo: dias fechados vêm da cache (calculados uma única vez)
+    e só o dia de hoje, se estiver no intervalo, é calculado na hora.
+    """
+    garantir_horas_em_cache(db, data_inicio, data_fim)
+    cursor = db.cursor()
+    query = "SELECT " + ", ".join(COLUNAS_HORAS) + " FROM horas_loja_dia WHERE dia BETWEEN %s AND %s"
+    params = [data_inicio, data_fim]
+    if usuario_id:
+        query += " AND usuario_id = %s"
+        params.append(usuario_id)
+    if loja_id:
+        query += " AND loja_id = %s"
+        params.append(loja_id)
+    cursor.execute(query, tuple(params))
+    linhas = [tuple(linha) for linha in cursor.fetchall()]
+    hoje = date.today()
+    if data_inicio <= hoje <= data_fim:
+        linhas.extend(calcular_horas(cursor, [hoje], usuario_id, loja_id))
+    cursor.close()
+    return [dict(zip(COLUNAS_HORAS, linha)) for linha in linhas]
+
+def filtros_horas():
+    """Lê os filtros do relatório de horas; o padrão são os últimos 30 dias."""
+    hoje = date.today()
+    try:
+        data_inicio = datetime.strptime(request.args.get('data_inicio', ''), '%Y-%m-%d').date()
+    except ValueError:
+        data_inicio = hoje - timedelta(days=30)
+    try:
+        data_fim = datetime.strptime(request.args.get('data_fim', ''), '%Y-%m-%d').date()
+    except ValueError:
+        data_fim = hoje
+    return {'data_inicio': data_inicio, 'data_fim': data_fim,
+            'promotora_id': request.args.get('promotora_id', type=int), 'loja_id': request.args.get('loja_id', type=int)}
+
+def nomes_horas(cursor, linhas):
+    """Dicionários id -> nome das promotoras e lojas presentes nas linhas."""
+    cursor.execute("SELECT id, nome_completo FROM usuarios WHERE id = ANY(%s)", (list({l['usuario_id'] for l in linhas}),))
+    promotoras = {r[0]: r[1] for r in cursor.fetchall()}
+    cursor.execute("SELECT id, razao_social FROM lojas WHERE id = ANY(%s)", (list({l['loja_id'] for l in linhas}),))
+    lojas = {r[0]: r[1] for r in cursor.fetchall()}
+    return promotoras, lojas
+
+@app.route('/admin/horas')
+def horas_em_loja():
+    if 'user_type' not in session or session['user_type'] != 'master': return redirect(url_for('login'))
     db = get_db()
+    filtros = filtros_horas()
+    linhas = horas_trabalhadas(db, filtros['data_inicio'], filtros['data_fim'], filtros['promotora_id'], filtros['loja_id'])
     cursor = db.cursor()
+    promotoras, lojas = nomes_horas(cursor, linhas)
+    cursor.close()
+    # Resumo do período por promotora e loja; o detalhe por dia fica na exportação.
+    resumo = {}
+    for linha in linhas:
+        chave = (linha['usuario_id'], linha['loja_id'])
+        item = resumo.setdefault(chave, {'promotora': promotoras.get(linha['usuario_id']), 'loja': lojas.get(linha['loja_id']),
+                                         'dias': 0, 'visitas': 0, 'visitas_sem_saida': 0, 'saidas_sem_entrada': 0, 'horas': 0.0})
+        item['dias'] += 1
+        for campo in ('visitas', 'visitas_sem_saida', 'saidas_sem_entrada', 'horas'):
+            item[campo] += linha[campo]
+    resumo = sorted(resumo.values(), key=lambda item: (item['promotora'] or '', item['loja'] or ''))
+    promotora_sel = [{'id': filtros['promotora_id'], 'nome_completo': promotoras.get(filtros['promotora_id'])}] if filtros['promotora_id'] else []
+    loja_sel = [{'id': filtros['loja_id'], 'razao_social': lojas.get(filtros['loja_id'])}] if filtros['loja_id'] else []
+    return render_template('horas.html', title="Horas em Loja", resumo=resumo, filtros=filtros, promotora_sel=promotora_sel, loja_sel=loja_sel)
 
-    # Buscar campos numéricos
-    cursor.execute("SELECT id, label_campo FROM campos_relatorio WHERE grupo_id = %s AND tipo = 'numero' ORDER BY id", (grupo_id,))
-    campos_numericos = [{"id": r[0], "label_campo": r[1]} for r in cursor.fetchall()]
+@app.route('/admin/horas/exportar')
+def exportar_horas():
+    if 'user_type' not in session or session['user_type'] != 'master': return redirect(url_for('login'))
+    import pandas as pd
+    db = get_db()
+    filtros = filtros_horas()
+    linhas = horas_trabalhadas(db, filtros['data_inicio'], filtros['data_fim'], filtros['promotora_id'], filtros['loja_id'])
+    if not linhas:
+        flash("Nenhum dado encontrado para exportar com os filtros selecionados.", "info")
+        return redirect(url_for('horas_em_loja', **request.args))
+    cursor = db.cursor()
+    promotoras, lojas = nomes_horas(cursor, linhas)
+    cursor.close()
+    df = pd.DataFrame(linhas)
+    df.insert(1, 'Promotora', df['usuario_id'].map(promotoras))
+    df.insert(2, 'Loja', df['loja_id'].map(lojas))
+    df = df.drop(columns=['usuario_id', 'loja_id']).sort_values(['dia', 'Promotora', 'Loja'])
+    df['horas'] = df['horas'].round(2)
+    df = df.rename(columns={'dia': 'Dia', 'visitas': 'Visitas', 'visitas_sem_saida': 'Visitas sem Saída',
+                            'saidas_sem_entrada': 'Saídas sem Entrada', 'horas': 'Horas'})
+    output = BytesIO()
+    df.to_excel(output, index=False, sheet_name='Horas_em_Loja')
+    output.seek(0)
+    return send_file(output, as_attachment=True, download_name=f'horas_em_loja_{filtros["data_inicio"]}_a_{filtros["data_fim"]}.xlsx')
+
+# --- CONFORMIDADE (relatórios e check-ins esperados por promotora, loja e dia) ---
+# Número máximo de dias calculados por INSERT/commit ao preencher a cache.
+CONFORMIDADE_DIAS_POR_LOTE = 31
+# Linhas mostradas na tela; a exportação traz todas.
+CONFORMIDADE_LIMITE_TELA = 500
+# Advisory lock do calcular-conformidade (um único cálculo noturno entre instâncias).
+CONFORMIDADE_LOCK = 36
 
-    # Buscar campos de texto
-    cursor.execute("SELECT id, label_campo FROM campos_relatorio WHERE grupo_id = %s AND tipo = 'texto' ORDER BY id", (grupo_id,))
-    campos_texto = [{"id": r[0], "label_campo": r[1]} for r in cursor.fetchall()]
+# Matriz esperado x realizado: cada associação em promotora_lojas deve ter um relatório e um check-in em cada dia
+# desde que foi criada (criado_em) e, se a promotora foi inativada, até à véspera da inativação (inativo_desde).
+# Relatórios e check-ins são reduzidos a (dia, promotora, loja) distintos e cruzados por LEFT JOIN (hash join),
+# em vez de um EXISTS por célula. Associações removidas não deixam rasto: os dias já guardados em conformidade_dia
+# (o calcular-conformidade noturno fecha cada dia) mantêm-nas, os dias ainda por calcular já não as veem.
+CONFORMIDADE_SQL = """
+    WITH atribuicoes AS (
+        SELECT pl.usuario_id, pl.loja_id, pl.criado_em::date AS desde, u.inativo_desde::date AS ate
+        FROM promotora_lojas pl JOIN usuarios u ON u.id = pl.usuario_id
+        WHERE u.tipo = 'promotora' AND (u.ativo = 1 OR u.inativo_desde IS NOT NULL) {filtros}
+    ), relatorios_dia AS (
+        SELECT DISTINCT data AS dia, usuario_id, loja_id FROM relatorios WHERE data = ANY(%(dias)s::date[])
+    ), checkins_dia AS (
+        SELECT DISTINCT data_hora::date AS dia, usuario_id, loja_id FROM checkins
+        WHERE data_hora >= %(inicio)s AND data_hora < %(fim)s AND tipo = 'checkin'
+    )
+    SELECT d.dia, a.usuario_id, a.loja_id, r.dia IS NOT NULL AS relatorio, c.dia IS NOT NULL AS checkin
+    FROM unnest(%(dias)s::date[]) d(dia)
+    JOIN atribuicoes a ON (a.desde IS NULL OR a.desde <= d.dia) AND (a.ate IS NULL OR d.dia < a.ate)
+    LEFT JOIN relatorios_dia r ON r.dia = d.dia AND r.usuario_id = a.usuario_id AND r.loja_id = a.loja_id
+    LEFT JOIN checkins_dia c ON c.dia = d.dia AND c.usuario_id = a.usuario_id AND c.loja_id = a.loja_id
+"""
 
+def sql_conformidade(dias, usuario_id=None, loja_id=None):
+    """CONFORMIDADE_SQL para os dias indicados, com os filtros opcionais; devolve (sql, params)."""
+    filtros, params = "", {'dias': list(dias), 'inicio': min(dias), 'fim': max(dias) + timedelta(days=1)}
+    if usuario_id:
+        filtros += " AND pl.usuario_id = %(usuario_id)s"
+        params['usuario_id'] = usuario_id
+    if loja_id:
+        filtros += " AND pl.loja_id = %(loja_id)s"
+        params['loja_id'] = loja_id
+    return CONFORMIDADE_SQL.format(filtros=filtros), params
+
+def garantir_conformidade_em_cache(db, data_inicio, data_fim):
+    """
+    Preenche conformidade_dia para os dias fechados (anteriores a hoje) do intervalo que ainda não foram calculados,
+    tudo no banco (INSERT ... SELECT). Como em horas_loja_dia, um dia fechado é calculado uma única vez.
+    """
+    fim_fechado = min(data_fim, date.today() - timedelta(days=1))
+    if data_inicio > fim_fechado:
+        return
+    cursor = db.cursor()
+    cursor.execute("""
+        SELECT d::date FROM generate_series(%s::date, %s::date, INTERVAL '1 day') d
+        WHERE NOT EXISTS (SELECT 1 FROM conformidade_dias_calculados c WHERE c.dia = d::date) ORDER BY 1
+    """, (data_inicio, fim_fechado))
+    faltam = [linha[0] for linha in cursor.fetchall()]
+    for i in range(0, len(faltam), CONFORMIDADE_DIAS_POR_LOTE):
+        lote = faltam[i:i + CONFORMIDADE_DIAS_POR_LOTE]
+        sql, params = sql_conformidade(lote)
+        cursor.execute("INSERT INTO conformidade_dia (dia, usuario_id, loja_id, relatorio, checkin) " + sql +
+                       " ON CONFLICT (dia, usuario_id, loja_id) DO NOTHING", params)
+        execute_values(cursor, "INSERT INTO conformidade_dias_calculados (dia) VALUES %s ON CONFLICT (dia) DO NOTHING", [(dia,) for dia in lote])
+        db.commit()
     cursor.close()
-    db.close()
 
-    return render_template("relatorios.html", campos_numericos=campos_numericos, campos_texto=campos_texto)
+def matriz_conformidade(db, data_inicio, data_fim, usuario_id=None, loja_id=None):
+    """
+    SQL da matriz (dia, usuario_id, loja_id, relatorio, checkin) do intervalo: dias fechados vêm da cache
+    e só o dia de hoje, se estiver no intervalo, é calculado na hora. Devolve (sql, params) para usar como subconsulta.
+    """
+    garantir_conformidade_em_cache(db, data_inicio, data_fim)
+    sql = "SELECT dia, usuario_id, loja_id, relatorio, checkin FROM conformidade_dia WHERE dia BETWEEN %(periodo_inicio)s AND %(periodo_fim)s"
+    params = {'periodo_inicio': data_inicio, 'periodo_fim': data_fim}
+    if usuario_id:
+        sql += " AND usuario_id = %(usuario_id)s"
+    if loja_id:
+        sql += " AND loja_id = %(loja_id)s"
+    hoje = date.today()
+    if data_inicio <= hoje <= data_fim:
+        sql_hoje, params_hoje = sql_conformidade([hoje], usuario_id, loja_id)
+        sql += " UNION ALL (" + sql_hoje + ")"
+        params.update(params_hoje)
+    params.update({'usuario_id': usuario_id, 'loja_id': loja_id})
+    return sql, params
+
+def resumo_conformidade(db, data_inicio, data_fim, usuario_id=None, loja_id=None, apenas_pendencias=False, limite=None):
+    """
+    Resumo por promotora e loja (dias esperados, dias com relatório, com check-in e sem nenhum dos dois),
+    das piores taxas para as melhores, e os totais do período inteiro (calculados antes do filtro de pendências e do limite).
+    """
+    matriz, params = matriz_conformidade(db, data_inicio, data_fim, usuario_id, loja_id)
+    # 'totais' tem sempre uma linha; as linhas dos pares entram por LEFT JOIN, por isso os totais chegam
+    # mesmo quando o filtro de pendências não deixa nenhum par.
+    query = f"""
+        WITH pares AS (
+            SELECT m.usuario_id, m.loja_id, COUNT(*) AS dias,
+                   COUNT(*) FILTER (WHERE m.relatorio) AS com_relatorio,
+                   COUNT(*) FILTER (WHERE m.checkin) AS com_checkin,
+                   COUNT(*) FILTER (WHERE NOT m.relatorio AND NOT m.checkin) AS ausente,
+                   COUNT(*) FILTER (WHERE m.relatorio AND m.checkin) AS completos
+            FROM ({matriz}) m
+            GROUP BY m.usuario_id, m.loja_id
+        ), totais AS (
+            SELECT COALESCE(SUM(dias), 0) AS total_dias, COALESCE(SUM(com_relatorio), 0) AS total_relatorio,
+                   COALESCE(SUM(com_checkin), 0) AS total_checkin, COUNT(*) AS total_pares
+            FROM pares
+        )
+        SELECT t.*, p.* FROM totais t LEFT JOIN LATERAL (
+            SELECT u.nome_completo AS promotora, l.razao_social AS loja, s.*
+            FROM pares s JOIN usuarios u ON u.id = s.usuario_id JOIN lojas l ON l.id = s.loja_id
+            {"WHERE s.completos < s.dias" if apenas_pendencias else ""}
+            ORDER BY s.completos::double precision / s.dias, u.nome_completo, l.razao_social
+            {"LIMIT %(limite)s" if limite else ""}
+        ) p ON TRUE
+        ORDER BY p.completos::double precision / p.dias, p.promotora, p.loja
+    """
+    params['limite'] = limite
+    cursor = db.cursor(cursor_factory=DictCursor)
+    cursor.execute(query, params)
+    resultado = cursor.fetchall()
+    cursor.close()
+    totais = {'dias': int(resultado[0]['total_dias']), 'relatorio': int(resultado[0]['total_relatorio']),
+              'checkin': int(resultado[0]['total_checkin']), 'pares': resultado[0]['total_pares']}
+    linhas = [dict(linha) for linha in resultado if linha['usuario_id'] is not None]
+    return linhas, totais
+
+def pendencias_conformidade(db, data_inicio, data_fim, usuario_id=None, loja_id=None):
+    """Dias em que faltou o relatório ou o check-in, lidos por um cursor do servidor à medida que são consumidos."""
+    matriz, params = matriz_conformidade(db, data_inicio, data_fim, usuario_id, loja_id)
+    query = f"""
+        SELECT m.dia, u.nome_completo, l.razao_social,
+               CASE WHEN m.relatorio THEN 'Sim' ELSE 'Não' END, CASE WHEN m.checkin THEN 'Sim' ELSE 'Não' END
+        FROM ({matriz}) m JOIN usuarios u ON u.id = m.usuario_id JOIN lojas l ON l.id = m.loja_id
+        WHERE NOT (m.relatorio AND m.checkin)
+        ORDER BY m.dia, u.nome_completo, l.razao_social
+    """
+    cursor = db.cursor(name='pendencias_conformidade')
+    cursor.itersize = RELATORIO_DIARIO_LOTE
+    try:
+        cursor.execute(query, params)
+        yield from cursor
+    finally:
+        cursor.close()
+
+def filtros_conformidade():
+    """Os filtros do relatório de horas (período, promotora e loja) e se a tela mostra só quem tem pendências."""
+    filtros = filtros_horas()
+    filtros['apenas_pendencias'] = request.args.get('apenas_pendencias', '1') == '1'
+    return filtros
+
+@app.route('/admin/conformidade')
+def conformidade():
+    if 'user_type' not in session or session['user_type'] != 'master': return redirect(url_for('login'))
+    db = get_db()
+    filtros = filtros_conformidade()
+    resumo, totais = resumo_conformidade(db, filtros['data_inicio'], filtros['data_fim'], filtros['promotora_id'], filtros['loja_id'],
+                                         filtros['apenas_pendencias'], CONFORMIDADE_LIMITE_TELA)
+    cursor = db.cursor()
+    cursor.execute("SELECT id, nome_completo FROM usuarios WHERE id = %s", (filtros['promotora_id'],))
+    promotora_sel = [{'id': r[0], 'nome_completo': r[1]} for r in cursor.fetchall()]
+    cursor.execute("SELECT id, razao_social FROM lojas WHERE id = %s", (filtros['loja_id'],))
+    loja_sel = [{'id': r[0], 'razao_social': r[1]} for r in cursor.fetchall()]
+    cursor.close()
+    return render_template('conformidade.html', title="Conformidade", resumo=resumo, totais=totais, filtros=filtros,
+                           promotora_sel=promotora_sel, loja_sel=loja_sel, limite=CONFORMIDADE_LIMITE_TELA)
+
+@app.route('/admin/conformidade/exportar')
+def exportar_conformidade():
+    if 'user_type' not in session or session['user_type'] != 'master': return redirect(url_for('login'))
+    from openpyxl import Workbook
+    db = get_db()
+    filtros = filtros_conformidade()
+    resumo, totais = resumo_conformidade(db, filtros['data_inicio'], filtros['data_fim'], filtros['promotora_id'], filtros['loja_id'])
+    if not resumo:
+        flash("Nenhum dado encontrado para exportar com os filtros selecionados.", "info")
+        return redirect(url_for('conformidade', **request.args))
+    wb = Workbook(write_only=True)
+    folha_write_only(wb, 'Resumo', ['Promotora', 'Loja', 'Dias Esperados', 'Dias com Relatório', 'Dias com Check-in', 'Dias sem Relatório nem Check-in'],
+                     ([r['promotora'], r['loja'], r['dias'], r['com_relatorio'], r['com_checkin'], r['ausente']] for r in resumo))
+    folha_write_only(wb, 'Pendencias', ['Dia', 'Promotora', 'Loja', 'Relatório', 'Check-in'],
+                     pendencias_conformidade(db, filtros['data_inicio'], filtros['data_fim'], filtros['promotora_id'], filtros['loja_id']))
+    output = BytesIO()
+    wb.save(output)
+    output.seek(0)
+    return send_file(output, as_attachment=True, download_name=f'conformidade_{filtros["data_inicio"]}_a_{filtros["data_fim"]}.xlsx')
+
+# --- BUSCA APROXIMADA (pg_trgm + unaccent) ---
+BUSCA_LIMITE_PADRAO = 20
+BUSCA_LIMITE_MAXIMO = 100
+
+# Expressões iguais às dos índices GIN criados em init_db(); se mudarem aqui, os índices deixam de ser usados.
+BUSCA_LOJA_TEXTO = "f_unaccent(lower(l.razao_social || ' ' || COALESCE(l.bandeira, '') || ' ' || COALESCE(l.cidade, '')))"
+BUSCA_LOJA_CNPJ = "regexp_replace(COALESCE(l.cnpj, ''), '\\D', '', 'g')"
+BUSCA_PROMOTORA_NOME = "f_unaccent(lower(COALESCE(u.nome_completo, '')))"
+BUSCA_PROMOTORA_TELEFONE = "regexp_replace(COALESCE(u.telefone, ''), '\\D', '', 'g')"
+
+def normalizar_busca(texto):
+    """Minúsculas e sem acentos, como f_unaccent(lower(...)) no banco."""
+    texto = unicodedata.normalize('NFKD', texto.lower())
+    return ''.join(c for c in texto if not unicodedata.combining(c)).strip()
+
+def padrao_like(texto):
+    """Padrão '%texto%' com os curingas do próprio texto escapados."""
+    return '%' + texto.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def _busca(termo, expressao_texto, expressao_digitos):
+    """
+    Monta a condição e a relevância de uma busca: substring ou semelhança de palavra no texto
+    normalizado e, se o termo for numérico com 3 ou mais dígitos, substring nos dígitos.
+    Devolve (condição, parâmetros da condição, relevância, parâmetros da relevância).
+    """
+    texto = normalizar_busca(termo)
+    digitos = re.sub(r'\D', '', termo)
+    condicoes = [f"{expressao_texto} LIKE %s", f"%s <%% {expressao_texto}"]
+    params = [padrao_like(texto), texto]
+    relevancia = f"word_similarity(%s, {expressao_texto})"
+    params_relevancia = [texto]
+    if len(digitos) >= 3 and not any(c.isalpha() for c in termo):
+        condicoes.append(f"{expressao_digitos} LIKE %s")
+        params.append(padrao_like(digitos))
+        relevancia = f"GREATEST({relevancia}, CASE WHEN {expressao_digitos} LIKE %s THEN 1 ELSE 0 END)"
+        params_relevancia.append(padrao_like(digitos))
+    return "(" + " OR ".join(condicoes) + ")", params, relevancia, params_relevancia
+
+def condicao_busca_lojas(termo):
+    condicao, params, _, _ = _busca(termo, BUSCA_LOJA_TEXTO, BUSCA_LOJA_CNPJ)
+    return condicao, params
+
+def condicao_busca_promotoras(termo):
+    condicao, params, _, _ = _busca(termo, BUSCA_PROMOTORA_NOME, BUSCA_PROMOTORA_TELEFONE)
+    return condicao, params
+
+def limite_busca():
+    limite = request.args.get('limite', BUSCA_LIMITE_PADRAO, type=int)
+    return min(max(limite, 1), BUSCA_LIMITE_MAXIMO)
+
+@app.route('/api/busca/lojas')
+def api_busca_lojas():
+    if 'user_type' not in session or session['user_type'] != 'master': return jsonify({'erro': 'Não autorizado'}), 403
+    termo = request.args.get('q', '').strip()
+    if len(normalizar_busca(termo)) < 2:
+        return jsonify({'itens': []})
+    condicao, params_condicao, relevancia, params_relevancia = _busca(termo, BUSCA_LOJA_TEXTO, BUSCA_LOJA_CNPJ)
+    where, params = filtros_lojas()
+    where.append(condicao)
+    query = (f"SELECT l.id, l.razao_social, l.bandeira, l.cnpj, l.cidade, l.uf, l.grupo_id, g.nome AS grupo_nome, {relevancia} AS relevancia "
+             "FROM lojas l LEFT JOIN grupos g ON l.grupo_id = g.id AND g.removido_em IS NULL WHERE " + " AND ".join(where) +
+             " ORDER BY relevancia DESC, l.razao_social LIMIT %s")
+    db = get_db()
+    cursor = db.cursor(cursor_factory=DictCursor)
+    cursor.execute(query, tuple(params_relevancia + params + params_condicao + [limite_busca()]))
+    lojas = [dict(linha) for linha in cursor.fetchall()]
+    cursor.close()
+    return jsonify({'itens': lojas})
+
+@app.route('/api/busca/promotoras')
+def api_busca_promotoras():
+    if 'user_type' not in session or session['user_type'] != 'master': return jsonify({'erro': 'Não autorizado'}), 403
+    termo = request.args.get('q', '').strip()
+    if len(normalizar_busca(termo)) < 2:
+        return jsonify({'itens': []})
+    condicao, params_condicao, relevancia, params_relevancia = _busca(termo, BUSCA_PROMOTORA_NOME, BUSCA_PROMOTORA_TELEFONE)
+    where, params = filtros_promotoras()
+    where.append(condicao)
+    query = (f"SELECT u.id, u.nome_completo, u.telefone, u.cidade, u.uf, u.ativo, {relevancia} AS relevancia "
+             "FROM usuarios u WHERE " + " AND ".join(where) +
+             " ORDER BY relevancia DESC, u.nome_completo LIMIT %s")
+    db = get_db()
+    cursor = db.cursor(cursor_factory=DictCursor)
+    cursor.execute(query, tuple(params_relevancia + params + params_condicao + [limite_busca()]))
+    promotoras = [dict(linha) for linha in cursor.fetchall()]
+    cursor.close()
+    return jsonify({'itens': promotoras})
+
+@app.route("/relatorios_avancados/<int:grupo_id>")
+def relatorios_avancados(grupo_id):
+    # Antiga página de campos do grupo; os campos são carregados na aba "Avançado" de /admin/relatorios.
+    if 'user_type' not in session or session['user_type'] != 'master': return redirect(url_for('login'))
+    return redirect(url_for('relatorios', tab='avancado', grupo_id=grupo_id))
 
 
 @app.route("/processar_relatorio", methods=["POST"])
@@ -898,9 +2022,508 @@ def logout():
     flash('Você foi desconectado com sucesso.', 'info')
     return redirect(url_for('login'))
 
+# --- PLANILHAS EM STREAMING ---
+# Linhas de dados por folha do Excel (1048576 menos o cabeçalho).
+EXCEL_MAX_LINHAS = 1048575
+
+def folha_write_only(wb, titulo, cabecalho, linhas, formatos=None):
+    """
+    Acrescenta a um Workbook(write_only=True) uma folha com o cabeçalho no mesmo estilo do pandas.to_excel
+    e escreve as linhas à medida que o iterável as produz (ex.: um cursor do servidor), sem as juntar em memória.
+    'formatos' mapeia o índice de uma coluna para o number_format das suas células.
+    """
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Alignment, Border, Font, Side
+    ws = wb.create_sheet(titulo)
+    borda = Side(style='thin')
+    celulas = []
+    for texto in cabecalho:
+        celula = WriteOnlyCell(ws, value=texto)
+        celula.font = Font(bold=True)
+        celula.border = Border(left=borda, right=borda, top=borda, bottom=borda)
+        celula.alignment = Alignment(horizontal='center', vertical='top')
+        celulas.append(celula)
+    ws.append(celulas)
+    for numero, linha in enumerate(linhas):
+        if numero == EXCEL_MAX_LINHAS - 1:
+            ws.append(['(limite de linhas do Excel atingido; filtre o período para ver o resto)'])
+            break
+        linha = list(linha)
+        for indice, formato in (formatos or {}).items():
+            linha[indice] = WriteOnlyCell(ws, value=linha[indice])
+            linha[indice].number_format = formato
+        ws.append(linha)
+    return ws
+
+# --- RELATÓRIO DIÁRIO (pivot feito no banco) ---
+# Linhas de dados_relatorio que entram no relatório diário de um grupo (valores nulos não contam, como no pivot_table).
+RELATORIO_DIARIO_FROM = """
+    FROM relatorios r JOIN usuarios u ON r.usuario_id = u.id JOIN lojas l ON r.loja_id = l.id
+    JOIN dados_relatorio dr ON r.id = dr.relatorio_id JOIN campos_relatorio cr ON dr.campo_id = cr.id
+    WHERE l.grupo_id = %s AND r.data = %s AND dr.valor IS NOT NULL AND cr.removido_em IS NULL
+"""
+# Linhas lidas do cursor do servidor de cada vez
+RELATORIO_DIARIO_LOTE = 2000
+
+def relatorio_diario(db, grupo_id, data):
+    """
+    Relatório diário em formato largo: uma linha por (data_hora, promotora, loja) e uma coluna por campo,
+    com o primeiro valor preenchido. Mesmo resultado do antigo pivot_table(aggfunc='first'): colunas e
+    linhas em ordem de código (COLLATE "C"), sem campos ou linhas totalmente vazios.
+    Devolve (labels, linhas); as linhas são lidas por um cursor do servidor à medida que são consumidas.
+    """
+    cursor = db.cursor()
+    cursor.execute(f'SELECT cr.label_campo {RELATORIO_DIARIO_FROM} GROUP BY cr.label_campo ORDER BY cr.label_campo COLLATE "C"', (grupo_id, data))
+    labels = [linha[0] for linha in cursor.fetchall()]
+    cursor.close()
+    colunas = ''.join(", (array_agg(dr.valor ORDER BY r.id, cr.id, dr.id) FILTER (WHERE cr.label_campo = %s))[1]" for _ in labels)
+    query = f"""
+        SELECT r.data_hora, u.nome_completo, l.razao_social{colunas} {RELATORIO_DIARIO_FROM}
+        GROUP BY r.data_hora, u.nome_completo, l.razao_social
+        ORDER BY r.data_hora, u.nome_completo COLLATE "C", l.razao_social COLLATE "C"
+    """
+
+    def linhas():
+        cursor = db.cursor(name='relatorio_diario')
+        cursor.itersize = RELATORIO_DIARIO_LOTE
+        try:
+            cursor.execute(query, labels + [grupo_id, data])
+            yield from cursor
+        finally:
+            cursor.close()
+
+    return labels, linhas()
+
+def relatorios_do_dia(cursor, grupo_id, data):
+    """
+    Relatórios do dia para a aba da tela, mais recentes primeiro: um item por relatório, mesmo sem valores
+    guardados, com os pares (campo, valor) dos campos não removidos. Ao contrário do pivot da exportação,
+    não junta relatórios com a mesma data/hora, promotora e loja.
+    """
+    cursor.execute("""
+        SELECT r.id, r.data_hora, u.nome_completo, l.razao_social,
+               COALESCE(json_agg(json_build_array(cr.label_campo, dr.valor) ORDER BY dr.id) FILTER (WHERE cr.id IS NOT NULL), '[]') AS dados
+        FROM relatorios r JOIN usuarios u ON r.usuario_id = u.id JOIN lojas l ON r.loja_id = l.id
+        LEFT JOIN dados_relatorio dr ON r.id = dr.relatorio_id
+        LEFT JOIN campos_relatorio cr ON dr.campo_id = cr.id AND cr.removido_em IS NULL
+        WHERE l.grupo_id = %s AND r.data = %s
+        GROUP BY r.id, u.nome_completo, l.razao_social
+        ORDER BY r.data_hora DESC, r.id DESC
+    """, (grupo_id, data))
+    return cursor.fetchall()
+
+# --- EXCLUSÃO EM SEGUNDO PLANO (campos e grupos) ---
+# Linhas apagadas/atualizadas por transação; cada lote faz commit e regista o progresso.
+PURGA_LOTE = int(os.environ.get('PURGA_LOTE', 5000))
+# Pausa entre lotes, para os envios de relatórios não ficarem à espera de locks.
+PURGA_PAUSA_SEGUNDOS = 0.05
+# Enquanto houver exclusões por concluir (ex.: presas no lock de outro processo), o worker volta a tentar neste
+# intervalo; sem nenhuma pendente, a thread termina e só é iniciada de novo por uma exclusão nova ou por api_exclusoes.
+PURGA_INTERVALO_SEGUNDOS = 60
+# Classe do advisory lock que garante um único worker por exclusão entre processos.
+PURGA_LOCK = 33
+
+def agendar_exclusao(cursor, tipo, alvo_id, descricao):
+    """Regista a exclusão na mesma transação que esconde o campo/grupo."""
+    cursor.execute("INSERT INTO exclusoes_pendentes (tipo, alvo_id, descricao) VALUES (%s, %s, %s)", (tipo, alvo_id, descricao))
+
+def etapas_exclusao(tipo, alvo_id):
+    """
+    Passos de uma exclusão: cada um é executado em lotes de PURGA_LOTE linhas até não afetar mais nenhuma,
+    e por fim 'final' remove a linha do campo/grupo. Todos são idempotentes, por isso retomar depois de
+    um reinício só repete o lote que não chegou a fazer commit.
+    """
+    if tipo == 'campo':
+        lotes = [("DELETE FROM dados_relatorio WHERE id IN (SELECT id FROM dados_relatorio WHERE campo_id = %s LIMIT %s)", (alvo_id,))]
+        contagem = ("SELECT COUNT(*) FROM dados_relatorio WHERE campo_id = %s", (alvo_id,))
+        final = [("DELETE FROM campos_relatorio WHERE id = %s", (alvo_id,))]
+    else:
+        campos = "SELECT id FROM campos_relatorio WHERE grupo_id = %s"
+        lotes = [
+            ("UPDATE lojas SET grupo_id = NULL WHERE id IN (SELECT id FROM lojas WHERE grupo_id = %s LIMIT %s)", (alvo_id,)),
+            (f"DELETE FROM dados_relatorio WHERE id IN (SELECT id FROM dados_relatorio WHERE campo_id IN ({campos}) LIMIT %s)", (alvo_id,)),
+        ]
+        contagem = (f"SELECT (SELECT COUNT(*) FROM lojas WHERE grupo_id = %s) + (SELECT COUNT(*) FROM dados_relatorio WHERE campo_id IN ({campos}))", (alvo_id, alvo_id))
+        final = [("DELETE FROM campos_relatorio WHERE grupo_id = %s", (alvo_id,)), ("DELETE FROM grupos WHERE id = %s", (alvo_id,))]
+    return lotes, contagem, final
+
+class PurgaExclusoes:
+    """
+    Worker (uma thread por processo) que apaga os dados de campos e grupos removidos em lotes pequenos,
+    cada um na sua transação. O estado fica em exclusoes_pendentes, por isso o trabalho é retomado depois
+    de um reinício e o progresso pode ser consultado em /api/admin/exclusoes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._acordar = threading.Event()
+        self._thread = None
+
+    def iniciar(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._executar, name='purga-exclusoes', daemon=True)
+                self._thread.start()
+
+    def acordar(self):
+        # O evento vem antes do iniciar(): uma thread prestes a terminar vê-o e continua (ver _executar).
+        self._acordar.set()
+        self.iniciar()
+
+    def processar_pendentes(self):
+        """
+        Executa todas as exclusões pendentes que nenhum outro processo esteja a tratar.
+        Devolve (concluídas, restantes), em que restantes são as que ficaram por concluir (lock de outro processo ou erro).
+        """
+        concluidas = 0
+        conexao = psycopg2.connect(app.config['DATABASE_URL'])
+        try:
+            cursor = conexao.cursor()
+            cursor.execute("SELECT id, tipo, alvo_id, total FROM exclusoes_pendentes WHERE concluido_em IS NULL ORDER BY id")
+            pendentes = cursor.fetchall()
+            conexao.commit()
+            for exclusao_id, tipo, alvo_id, total in pendentes:
+                cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", (PURGA_LOCK, exclusao_id))
+                if not cursor.fetchone()[0]:
+                    conexao.commit()
+                    continue
+                try:
+                    self._processar(conexao, exclusao_id, tipo, alvo_id, total)
+                    concluidas += 1
+                except Exception as e:
+                    conexao.rollback()
+                    cursor.execute("UPDATE exclusoes_pendentes SET erro = %s WHERE id = %s", (str(e), exclusao_id))
+                    conexao.commit()
+                    print(f"Erro na exclusão {exclusao_id}: ", e)
+                finally:
+                    cursor.execute("SELECT pg_advisory_unlock(%s, %s)", (PURGA_LOCK, exclusao_id))
+                    conexao.commit()
+        finally:
+            conexao.close()
+        return concluidas, len(pendentes) - concluidas
+
+    def _processar(self, conexao, exclusao_id, tipo, alvo_id, total):
+        cursor = conexao.cursor()
+        lotes, contagem, final = etapas_exclusao(tipo, alvo_id)
+        if total is None:
+            cursor.execute(contagem[0], contagem[1])
+            cursor.execute("UPDATE exclusoes_pendentes SET total = removidos + %s, erro = NULL WHERE id = %s", (cursor.fetchone()[0], exclusao_id))
+            conexao.commit()
+        while True:
+            for sql, params in lotes:
+                while True:
+                    cursor.execute(sql, params + (PURGA_LOTE,))
+                    afetadas = cursor.rowcount
+                    cursor.execute("UPDATE exclusoes_pendentes SET removidos = removidos + %s WHERE id = %s", (afetadas, exclusao_id))
+                    conexao.commit()
+                    if afetadas < PURGA_LOTE:
+                        break
+                    time.sleep(PURGA_PAUSA_SEGUNDOS)
+            try:
+                for sql, params in final:
+                    cursor.execute(sql, params)
+                cursor.execute("UPDATE exclusoes_pendentes SET concluido_em = NOW(), erro = NULL WHERE id = %s", (exclusao_id,))
+                conexao.commit()
+                return
+            except psycopg2.IntegrityError:
+                # Um relatório gravado entre o último lote e o DELETE final ainda referencia o campo: repete os lotes.
+                conexao.rollback()
+
+    def _executar(self):
+        while True:
+            self._acordar.clear()
+            restantes = 1
+            try:
+                _, restantes = self.processar_pendentes()
+            except Exception as e:
+                print("Erro no worker de exclusão: ", e)
+            if restantes:
+                self._acordar.wait(PURGA_INTERVALO_SEGUNDOS)
+                continue
+            with self._lock:
+                if not self._acordar.is_set():
+                    self._thread = None
+                    return
+
+purga = PurgaExclusoes()
+
+# --- VERIFICAÇÃO DE PLANOS DE CONSULTA ---
+# Tabelas com pelo menos estas linhas (depois da semeadura) não podem ser lidas por Seq Scan.
+PLANO_MIN_LINHAS = 10000
+# Tabelas de cadastro: lê-las inteiras (contagens do painel, junções com todas as promotoras ou lojas) é esperado.
+# Nelas só conta o Seq Scan que filtra e deixa passar menos desta fração das linhas, sinal de índice em falta.
+PLANO_TABELAS_CADASTRO = {'lojas', 'usuarios', 'promotora_lojas'}
+PLANO_FRACAO_FILTRO = 0.5
+# Custo estimado máximo (unidades do planejador) de cada consulta emitida por uma rota.
+PLANO_CUSTO_MAXIMO = float(os.environ.get('PLANO_CUSTO_MAXIMO', 5000))
+# Rotas que leem uma tabela inteira por definição; não entram na regra do Seq Scan nem do custo.
+PLANO_ISENTOS = {
+    'exportar_lojas': 'exporta todas as lojas',
+    'exportar_promotoras': 'exporta todas as associações promotora/loja',
+}
+# Rotas que não emitem SQL próprio ou que não podem ser exercitadas num pedido de teste.
+PLANO_IGNORADOS = {'static', 'logout', 'obrigado', 'dashboard_stream'}
+# Esquema descartável, dentro da base de teste, onde a verificação cria as tabelas e semeia os dados.
+PLANO_ESQUEMA = 'verificacao_planos'
+
+def pedidos_verificacao(ids):
+    """
+    Pedidos usados para exercitar cada rota (perfil, método, endpoint, argumentos da URL, dados do formulário).
+    Usam os filtros que ativam os ramos com SQL; uma rota GET nova tem de entrar aqui, senão a verificação falha.
+    """
+    hoje = date.today().isoformat()
+    semana = (date.today() - timedelta(days=7)).isoformat()
+    checkins = {'filtro_checkin_data_inicio': semana, 'filtro_checkin_data_fim': hoje,
+                'filtro_checkin_promotora_id': ids['promotora'], 'filtro_checkin_loja_id': ids['loja']}
+    avancado = {'grupo_id': ids['grupo'], 'campos': f"{ids['campo']}_total", 'data_inicio': semana, 'data_fim': hoje}
+    return [
+        ('master', 'GET', 'login', {}, None),
+        ('master', 'GET', 'admin_redirect', {}, None),
+        ('master', 'GET', 'dashboard', {}, None),
+        ('master', 'GET', 'dashboard_dados', {}, None),
+        ('master', 'GET', 'gerenciamento', {}, None),
+        ('master', 'GET', 'gerenciar_grupos', {}, None),
+        ('master', 'GET', 'detalhe_grupo', {'id': ids['grupo']}, None),
+        ('master', 'GET', 'edit_loja', {'id': ids['loja']}, None),
+        ('master', 'GET', 'edit_promotora', {'id': ids['promotora']}, None),
+        ('master', 'GET', 'api_lojas', {'q': 'sao', 'grupo_id': ids['grupo']}, None),
+        ('master', 'GET', 'api_lojas', {'ordem': 'cidade', 'direcao': 'desc'}, None),
+        ('master', 'GET', 'api_promotoras', {'q': 'ana', 'ativo': '1'}, None),
+        ('master', 'GET', 'api_promotoras', {'ordem': 'telefone'}, None),
+        ('master', 'GET', 'api_busca_lojas', {'q': 'sao joao'}, None),
+        ('master', 'GET', 'api_busca_lojas', {'q': '1234'}, None),
+        ('master', 'GET', 'api_busca_promotoras', {'q': 'angela'}, None),
+        ('master', 'GET', 'api_exclusoes', {}, None),
+        ('master', 'GET', 'api_campos_grupo', {'grupo_id': ids['grupo']}, None),
+        ('master', 'GET', 'relatorios', {'tab': 'diario', 'filtro_grupo_id': ids['grupo'], 'filtro_data': hoje, **checkins}, None),
+        ('master', 'POST', 'relatorios', {}, avancado),
+        ('master', 'GET', 'relatorios_avancados', {'grupo_id': ids['grupo']}, None),
+        ('master', 'GET', 'exportar_relatorio_diario', {'filtro_grupo_id': ids['grupo'], 'filtro_data': hoje}, None),
+        ('master', 'GET', 'exportar_relatorio_avancado', avancado, None),
+        ('master', 'GET', 'exportar_historico_checkin', checkins, None),
+        ('master', 'GET', 'exportar_lojas', {}, None),
+        ('master', 'GET', 'exportar_promotoras', {}, None),
+        ('master', 'GET', 'horas_em_loja', {'data_inicio': semana, 'data_fim': hoje, 'promotora_id': ids['promotora']}, None),
+        ('master', 'GET', 'exportar_horas', {'data_inicio': semana, 'data_fim': hoje, 'loja_id': ids['loja']}, None),
+        ('master', 'GET', 'conformidade', {'data_inicio': semana, 'data_fim': hoje}, None),
+        ('master', 'GET', 'conformidade', {'data_inicio': semana, 'data_fim': hoje, 'promotora_id': ids['promotora'], 'apenas_pendencias': '0'}, None),
+        ('master', 'GET', 'exportar_conformidade', {'data_inicio': semana, 'data_fim': hoje, 'loja_id': ids['loja']}, None),
+        ('master', 'GET', 'performance', {}, None),
+        ('promotora', 'GET', 'formulario', {}, None),
+        ('promotora', 'GET', 'checkin', {}, None),
+        ('promotora', 'GET', 'enviar_imagem', {}, None),
+        ('promotora', 'GET', 'api_loja_proxima', {'latitude': -23.55, 'longitude': -46.63}, None),
+    ]
+
+def conexao_registrada(consultas):
+    """Fábrica de conexões que guarda (endpoint, SQL já com os parâmetros) de cada execute feito durante os pedidos."""
+    classes = {}
+
+    def cursor_registrado(base):
+        if base not in classes:
+            def execute(self, query, vars=None):
+                resultado = base.execute(self, query, vars)
+                sql = re.sub(r'^DECLARE\s+"?\w+"?\s+CURSOR\s+.*?\bFOR\s+', '', self.query.decode(), flags=re.S | re.I)
+                consultas.append((request.endpoint if has_request_context() else None, sql))
+                return resultado
+            classes[base] = type(base.__name__ + 'Registrado', (base,), {'execute': execute})
+        return classes[base]
+
+    class ConexaoRegistrada(psycopg2.extensions.connection):
+        def cursor(self, *args, **kwargs):
+            kwargs['cursor_factory'] = cursor_registrado(kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor)
+            return super().cursor(*args, **kwargs)
+
+    return ConexaoRegistrada
+
+TABELAS_SEMEADAS = "grupos, lojas, usuarios, promotora_lojas, campos_relatorio, relatorios, dados_relatorio, checkins"
+
+def semear_verificacao(cursor, linhas):
+    """
+    Dados sintéticos para o planejador ver tabelas do tamanho de produção. Lojas e usuários chegam a PLANO_MIN_LINHAS,
+    para que as buscas e listagens sobre eles também passem pela regra do Seq Scan. Devolve os ids usados nos pedidos
+    (pedidos_verificacao): um grupo com campos, uma promotora com lojas desse grupo, uma das lojas e um campo numérico.
+    """
+    cursor.execute("INSERT INTO grupos (nome) VALUES ('plano_verificacao') RETURNING id")
+    grupo_id = cursor.fetchone()[0]
+    cursor.execute("""
+        INSERT INTO lojas (razao_social, cnpj, cidade, uf, grupo_id, latitude, longitude)
+        SELECT 'Plano Loja ' || i, 'plano' || i, 'Cidade ' || (i %% 50), 'SP', %s, -24 + random() * 3, -47 + random() * 3
+        FROM generate_series(1, %s) i RETURNING id
+    """, (grupo_id, max(linhas // 2, PLANO_MIN_LINHAS)))
+    lojas = [linha[0] for linha in cursor.fetchall()]
+    cursor.execute("""
+        INSERT INTO usuarios (usuario, senha_hash, tipo, nome_completo, telefone, cidade, uf)
+        SELECT 'plano_' || i, 'x', 'promotora', 'Plano Promotora ' || i, 'plano' || i, 'Cidade ' || (i %% 50), 'SP'
+        FROM generate_series(1, %s) i RETURNING id
+    """, (max(linhas // 2, PLANO_MIN_LINHAS),))
+    usuarios = [linha[0] for linha in cursor.fetchall()]
+    cursor.execute("""
+        INSERT INTO promotora_lojas (usuario_id, loja_id)
+        SELECT DISTINCT u, (%s::int[])[1 + floor(random() * %s)::int] FROM unnest(%s::int[]) u, generate_series(1, 5)
+    """, (lojas, len(lojas), usuarios))
+    cursor.execute("""
+        INSERT INTO campos_relatorio (grupo_id, nome_campo, label_campo, tipo)
+        SELECT %s, 'plano_' || i, 'Plano ' || i, CASE WHEN i %% 2 = 0 THEN 'numero' ELSE 'texto' END FROM generate_series(1, 5) i RETURNING id
+    """, (grupo_id,))
+    campos = [linha[0] for linha in cursor.fetchall()]
+    aleatorio = "(%(usuarios)s::int[])[1 + floor(random() * %(n_usuarios)s)::int], (%(lojas)s::int[])[1 + floor(random() * %(n_lojas)s)::int], NOW() - random() * INTERVAL '365 days'"
+    params = {'usuarios': usuarios, 'n_usuarios': len(usuarios), 'lojas': lojas, 'n_lojas': len(lojas), 'linhas': linhas}
+    cursor.execute(f"""
+        INSERT INTO relatorios (usuario_id, loja_id, data, data_hora)
+        SELECT u, l, dh::date, dh FROM (SELECT {aleatorio} FROM generate_series(1, %(linhas)s)) s(u, l, dh) RETURNING id
+    """, params)
+    cursor.execute("""
+        INSERT INTO dados_relatorio (relatorio_id, campo_id, valor)
+        SELECT r.id, c, (random() * 100)::int::text FROM relatorios r, unnest(%s::int[]) c WHERE r.loja_id = ANY(%s)
+    """, (campos, lojas))
+    cursor.execute(f"""
+        INSERT INTO checkins (usuario_id, loja_id, tipo, data_hora, latitude, longitude, imagem_path)
+        SELECT u, l, CASE WHEN random() < 0.5 THEN 'checkin' ELSE 'checkout' END, dh, -24 + random() * 3, -47 + random() * 3, 'plano.jpg'
+        FROM (SELECT {aleatorio} FROM generate_series(1, %(linhas)s)) s(u, l, dh)
+    """, params)
+    cursor.execute(f"ANALYZE {TABELAS_SEMEADAS}")
+    cursor.execute("SELECT loja_id FROM promotora_lojas WHERE usuario_id = %s ORDER BY loja_id LIMIT 1", (usuarios[0],))
+    loja_id = cursor.fetchone()[0]
+    cursor.execute("SELECT id FROM usuarios WHERE tipo = 'master' ORDER BY id LIMIT 1")
+    master_id = cursor.fetchone()[0]
+    return {'grupo': grupo_id, 'loja': loja_id, 'promotora': usuarios[0], 'campo': campos[1], 'master': master_id}
+
+def problemas_plano(no, grandes):
+    """Percorre o plano (EXPLAIN FORMAT JSON) à procura de Seq Scan em tabelas grandes."""
+    if no['Node Type'] == 'Seq Scan' and no['Relation Name'] in grandes:
+        tabela, total = no['Relation Name'], grandes[no['Relation Name']]
+        if tabela not in PLANO_TABELAS_CADASTRO:
+            yield f"Seq Scan em {tabela} (~{total:.0f} linhas)"
+        elif 'Filter' in no and no['Plan Rows'] < total * PLANO_FRACAO_FILTRO:
+            yield f"Seq Scan filtrado em {tabela} (~{no['Plan Rows']:.0f} de ~{total:.0f} linhas)"
+    for filho in no.get('Plans', []):
+        yield from problemas_plano(filho, grandes)
+
+@app.cli.command('check-query-plans')
+@click.option('--database-url', envvar='TEST_DATABASE_URL', help='Base de teste dedicada (padrão: TEST_DATABASE_URL). Nunca a da aplicação.')
+@click.option('--linhas', type=int, default=20000, show_default=True, help='Linhas sintéticas de relatórios e check-ins.')
+@click.option('--custo', type=float, default=None, help='Custo máximo por consulta (padrão: PLANO_CUSTO_MAXIMO).')
+@click.option('--verbose', '-v', is_flag=True, help='Mostra o plano resumido de todas as consultas.')
+def check_query_plans_command(database_url, linhas, custo, verbose):
+    """
+    Cria as tabelas num esquema descartável da base de teste, semeia-o, exercita as rotas contra esses dados,
+    recolhe o SQL que emitem e corre EXPLAIN. Falha em Seq Scan de tabelas grandes, custo acima do orçamento,
+    resposta 5xx ou rota GET sem pedido em pedidos_verificacao().
+    """
+    if not database_url:
+        raise click.ClickException("Indique uma base de teste dedicada com --database-url ou TEST_DATABASE_URL.")
+    if database_url == app.config.get('DATABASE_URL'):
+        raise click.ClickException("A base de teste não pode ser a DATABASE_URL da aplicação: os pedidos gravam caches e dados.")
+    custo = custo if custo is not None else PLANO_CUSTO_MAXIMO
+    conexao = psycopg2.connect(database_url)
+    cursor = conexao.cursor()
+    cursor.execute(f"DROP SCHEMA IF EXISTS {PLANO_ESQUEMA} CASCADE")
+    cursor.execute(f"CREATE SCHEMA {PLANO_ESQUEMA}")
+    # As extensões ficam em public (f_unaccent refere public.unaccent) e não são apagadas com o esquema.
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm SCHEMA public")
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS unaccent SCHEMA public")
+    conexao.commit()
+    conexao.close()
+
+    # Todas as conexões da app (pedidos, init_db) passam a usar o esquema descartável da base de teste.
+    dsn = psycopg2.extensions.make_dsn(database_url, options=f'-c search_path={PLANO_ESQUEMA},public')
+    chaves = ('DATABASE_URL', 'DB_CONNECTION_FACTORY', 'PAINEL_AO_VIVO', 'SECRET_KEY')
+    configuracao_original = {chave: app.config[chave] for chave in chaves if chave in app.config}
+    consultas = []
+    falhas = []
+    exercitados = set()
+    vistas = set()
+    grandes = {}
+    try:
+        # Chave descartável: os pedidos usam sessões com login, que não abrem sem SECRET_KEY.
+        app.config.update(DATABASE_URL=dsn, DB_CONNECTION_FACTORY=None, PAINEL_AO_VIVO=False, SECRET_KEY=secrets.token_hex(16))
+        close_connection(None)
+        init_db()
+        close_connection(None)
+        conexao = psycopg2.connect(dsn)
+        cursor = conexao.cursor()
+        ids = semear_verificacao(cursor, linhas)
+        conexao.commit()
+        # Como em produção (cron noturno), os dias fechados da conformidade já estão em cache: a rota só calcula hoje.
+        garantir_conformidade_em_cache(get_db(), date.today() - timedelta(days=8), date.today() - timedelta(days=1))
+        close_connection(None)
+
+        app.config['DB_CONNECTION_FACTORY'] = conexao_registrada(consultas)
+        cliente = app.test_client()
+        for perfil, metodo, endpoint, argumentos, dados in pedidos_verificacao(ids):
+            with cliente.session_transaction() as sessao:
+                sessao.clear()
+                sessao['user_type'] = perfil
+                sessao['user_id'] = ids['promotora'] if perfil == 'promotora' else ids['master']
+            with app.test_request_context():
+                url = url_for(endpoint, **argumentos)
+            resposta = cliente.open(url, method=metodo, data=dados)
+            close_connection(None) # O contexto da CLI é reaproveitado pelos pedidos; cada pedido tem a sua conexão
+            exercitados.add(endpoint)
+            if resposta.status_code >= 500:
+                falhas.append(f"{endpoint}: {metodo} {url} devolveu {resposta.status_code}")
+        for regra in app.url_map.iter_rules():
+            if 'GET' in regra.methods and regra.endpoint not in exercitados | PLANO_IGNORADOS:
+                falhas.append(f"{regra.endpoint}: rota GET sem pedido em pedidos_verificacao()")
+
+        cursor.execute("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r' AND relnamespace = %s::regnamespace AND reltuples >= %s",
+                       (PLANO_ESQUEMA, PLANO_MIN_LINHAS))
+        grandes = dict(cursor.fetchall())
+        conexao.commit()
+        for endpoint, sql in consultas:
+            if (endpoint, sql) in vistas or not re.match(r'\s*(SELECT|WITH|UPDATE|DELETE|INSERT)\b', sql, re.I):
+                continue
+            vistas.add((endpoint, sql))
+            cursor.execute("SAVEPOINT plano")
+            try:
+                cursor.execute("EXPLAIN (FORMAT JSON) " + sql)
+                plano = cursor.fetchone()[0][0]['Plan']
+            except psycopg2.Error as e:
+                cursor.execute("ROLLBACK TO SAVEPOINT plano")
+                falhas.append(f"{endpoint}: EXPLAIN falhou ({str(e).strip()}): {' '.join(sql.split())[:200]}")
+                continue
+            problemas = [] if endpoint in PLANO_ISENTOS else list(problemas_plano(plano, grandes))
+            if endpoint not in PLANO_ISENTOS and plano['Total Cost'] > custo:
+                problemas.append(f"custo {plano['Total Cost']:.0f} acima de {custo:.0f}")
+            if verbose or problemas:
+                click.echo(f"{endpoint}: {plano['Node Type']} custo={plano['Total Cost']:.0f} {' '.join(sql.split())[:160]}")
+            falhas.extend(f"{endpoint}: {problema}: {' '.join(sql.split())[:200]}" for problema in problemas)
+        conexao.rollback()
+        conexao.close()
+    finally:
+        if not conexao.closed:
+            conexao.close() # Uma transação a meio seguraria locks e o DROP SCHEMA ficaria à espera
+        close_connection(None)
+        for chave in chaves:
+            app.config.pop(chave, None)
+        app.config.update(configuracao_original)
+        conexao = psycopg2.connect(database_url)
+        conexao.cursor().execute(f"DROP SCHEMA IF EXISTS {PLANO_ESQUEMA} CASCADE")
+        conexao.commit()
+        conexao.close()
+    click.echo(f"{len(vistas)} consultas de {len(exercitados)} rotas verificadas (tabelas grandes: {', '.join(sorted(grandes))}).")
+    if falhas:
+        for falha in falhas:
+            click.echo(f"  - {falha}", err=True)
+        raise click.ClickException(f"{len(falhas)} problema(s) nos planos de consulta.")
+
 # --- BLOCO DE INICIALIZAÇÃO E EXECUÇÃO ---
-with app.app_context():
-    init_db()
-    
+def configurar_app(config=None):
+    """
+    Aplica a configuração (variáveis de ambiente e 'config') à app do módulo e devolve-a, sem tocar na base de dados.
+    Não é uma fábrica: há uma única app por processo. O esquema é criado à parte com 'flask --app app init-db'.
+    """
+    app.secret_key = os.environ.get('SECRET_KEY')
+    app.config['DATABASE_URL'] = os.environ.get('DATABASE_URL')
+    if config:
+        app.config.update(config)
+    return app
+
+# O nome 'application' é o padrão que o Elastic Beanstalk procura.
+application = configurar_app()
+
 if __name__ == '__main__':
+    with app.app_context():
+        init_db()
     application.run(host='127.0.0.1', port=5000, debug=True)
\ No newline at end of file
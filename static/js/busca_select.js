@@ -0,0 +1,28 @@
+// Busca de promotoras e lojas nos filtros: cada <input data-busca-para="id_do_select"> repopula
+// o select associado com os melhores resultados da API indicada em select.dataset.busca,
+// mantendo a opção "Todas" e a opção já selecionada.
+document.addEventListener('DOMContentLoaded', function() {
+    document.querySelectorAll('input[data-busca-para]').forEach(function(campo) {
+        const select = document.getElementById(campo.dataset.buscaPara);
+        let timer = null;
+        let pedido = 0;
+        campo.addEventListener('input', function() {
+            clearTimeout(timer);
+            timer = setTimeout(function() {
+                const atual = ++pedido;
+                fetch(select.dataset.busca + '?' + new URLSearchParams({q: campo.value}).toString())
+                    .then(response => response.json())
+                    .then(dados => {
+                        if (atual !== pedido) return; // Resposta de uma busca já substituída
+                        Array.from(select.options).forEach(function(option) {
+                            if (option.value !== '' && !option.selected) option.remove();
+                        });
+                        dados.itens.forEach(function(item) {
+                            if (select.querySelector('option[value="' + item.id + '"]')) return;
+                            select.add(new Option(item.razao_social || item.nome_completo, item.id));
+                        });
+                    });
+            }, 300);
+        });
+    });
+});
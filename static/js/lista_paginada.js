@@ -0,0 +1,74 @@
+// Listagens paginadas por keyset das telas de gerenciamento (/api/admin/lojas, /api/admin/promotoras).
+
+// Carrega páginas de um endpoint paginado por keyset, recomeçando quando os filtros mudam.
+// 'url' pode ser uma função, para alternar entre a listagem e a busca por relevância.
+function listaPaginada(url, obterFiltros, desenhar, botaoMais) {
+    let proximo = null;
+    let ordem = null;
+    let direcao = 'asc';
+    let pedido = 0;
+
+    function carregar(reiniciar) {
+        const params = new URLSearchParams(obterFiltros());
+        if (ordem) { params.set('ordem', ordem); params.set('direcao', direcao); }
+        if (!reiniciar && proximo) {
+            params.set('apos_valor', proximo.apos_valor);
+            params.set('apos_id', proximo.apos_id);
+        }
+        const atual = ++pedido;
+        fetch((typeof url === 'function' ? url() : url) + '?' + params.toString())
+            .then(function(resp) { return resp.json(); })
+            .then(function(dados) {
+                if (atual !== pedido) return; // Resposta de uma busca já substituída
+                desenhar(dados.itens, reiniciar);
+                proximo = dados.proximo;
+                if (botaoMais) botaoMais.classList.toggle('d-none', !proximo);
+            });
+    }
+    if (botaoMais) botaoMais.addEventListener('click', function() { carregar(false); });
+    return {
+        recarregar: function() { carregar(true); },
+        ordenar: function(coluna) {
+            direcao = (ordem === coluna && direcao === 'asc') ? 'desc' : 'asc';
+            ordem = coluna;
+            carregar(true);
+        }
+    };
+}
+
+function aoDigitar(elemento, callback) {
+    let timer = null;
+    elemento.addEventListener('input', function() {
+        clearTimeout(timer);
+        timer = setTimeout(callback, 300);
+    });
+}
+
+// Seletor de lojas dos formulários de promotora (#selectLojas e os seus filtros).
+// Com texto digitado usa a busca por relevância (top N); sem texto, a listagem paginada.
+// As lojas já selecionadas são mantidas quando a busca recomeça.
+function seletorLojas(urlLista, urlBusca) {
+    const filtroGrupo = document.getElementById('filtroGrupoLojas');
+    const filtroUf = document.getElementById('filtroUfLojas');
+    const buscaSelect = document.getElementById('buscaSelectLojas');
+    const selectLojas = document.getElementById('selectLojas');
+    const seletor = listaPaginada(
+        function() { return buscaSelect.value.trim() ? urlBusca : urlLista; },
+        function() { return {q: buscaSelect.value, grupo_id: filtroGrupo.value, uf: filtroUf.value}; },
+        function(itens, reiniciar) {
+            if (reiniciar) {
+                Array.from(selectLojas.options).forEach(function(option) {
+                    if (!option.selected) option.remove();
+                });
+            }
+            itens.forEach(function(loja) {
+                if (selectLojas.querySelector('option[value="' + loja.id + '"]')) return;
+                selectLojas.add(new Option(loja.razao_social, loja.id));
+            });
+        },
+        document.getElementById('maisSelectLojas'));
+    filtroGrupo.addEventListener('change', seletor.recarregar);
+    aoDigitar(filtroUf, seletor.recarregar);
+    aoDigitar(buscaSelect, seletor.recarregar);
+    return seletor;
+}
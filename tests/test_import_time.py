@@ -0,0 +1,7 @@
+import app
+
+
+def test_import_dentro_do_orcamento():
+    duracao, pesados = app.medir_import()
+    assert not pesados, f"Módulos pesados carregados no import: {', '.join(pesados)}"
+    assert duracao <= app.IMPORT_TIME_BUDGET, f"import app levou {duracao:.3f}s (orçamento: {app.IMPORT_TIME_BUDGET:.3f}s)"
@@ -0,0 +1,13 @@
+import os
+
+import pytest
+
+import app
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+
+
+@pytest.mark.skipif(not TEST_DATABASE_URL, reason='TEST_DATABASE_URL não definida (Postgres de teste dedicado)')
+def test_planos_de_consulta():
+    resultado = app.app.test_cli_runner().invoke(args=['check-query-plans', '--database-url', TEST_DATABASE_URL])
+    assert resultado.exit_code == 0, resultado.output